@@ -2,7 +2,9 @@
 import matplotlib; matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 
-import glob, pickle, csv, dadi
+import csv, dadi, numpy
+
+from pipeline_dadi import replicate_targets
 
 group = 'all-pops'
 pop1 = 'DOM'
@@ -17,19 +19,18 @@ model = 'split_mig'
 
 polarised = True
 
-grid_size = [10, 50, 60]
+# the results of the default optimiser and engine
+optimizer = 'bfgs'
+engine = 'dadi'
 
-# make a master list of optimal params
-p_best = []
+grid_size = [10, 50, 60]
 
-for opt in glob.glob("fsdata/opt/{}_{}_{}_{}_{}_*.opt".format(group, pop1, pop2, model, scenario)):
-    print opt
-    with open(opt, 'r') as fin:
-        # unpickle the optimal params
-        p_best += pickle.load(fin)
+# make a master array of optimal params (n.b. a glob would also match the results of the other optimisers and engines)
+opts = [opt.path for opt in replicate_targets(group, pop1, pop2, model, scenario, optimizer, engine) if opt.exists()]
+p_best = numpy.vstack([numpy.load(opt)['p_best'] for opt in opts])
 
 # sort the params (largest ll_model first)
-p_best.sort(reverse=True)
+p_best = p_best[numpy.argsort(-p_best[:, 0], kind='mergesort')]
 
 param_names = ['s',    # Size of pop 1 after split. (Pop 2 has size 1-s.)
                'nu1',  # Final size of pop 1.
@@ -45,10 +46,10 @@ header = ["likelihood", "theta"] + list(param_names)
 with open("fsdata/{}_{}_{}_{}_{}.csv".format(group, pop1, pop2, model, scenario), "w") as fout:
     writer = csv.writer(fout)
     writer.writerow(header)
-    writer.writerows(p_best)
+    writer.writerows(p_best.tolist())
 
 # get the params with the maximum log likelihood, from all ~1e6 iterations
-p_opt = p_best[0][2:]
+p_opt = p_best[0, 2:].tolist()
 
 polar = '_folded' if not polarised else ''
 
@@ -5,9 +5,9 @@ group = 'all-pops'
 # log everything to file
 logging.basicConfig(filename="fsdata/{0}.log".format(group), level=logging.DEBUG)
 
-# generate the frequency spectrum
-fsdata = generate_frequency_spectrum(GROUPS[group])
+# extract the sites from each population
+populations = dict((pop, extract_variant_sites(pop, samples)) for pop, samples in GROUPS[group].iteritems())
 
-# save the fsdata file
-with open('fsdata.tmp', 'w') as fout:
-    fout.write(fsdata)
\ No newline at end of file
+# generate the frequency spectrum, and stream it into the fsdata file
+with open('fsdata.tmp', 'w', IO_BUFFER_SIZE) as fout:
+    generate_frequency_spectrum(populations, fout)
\ No newline at end of file
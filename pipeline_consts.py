@@ -109,6 +109,17 @@ GROUPS['split-fre']['FRE-2'] = ['SRR997303', 'SRR997305', 'SRR997319']
 # the samtools flag for BAM file comression
 DEFAULT_COMPRESSION = 6
 
+# size of the buffers used when streaming large files (1 MiB)
+IO_BUFFER_SIZE = 1 << 20
+
+# BAM streams which are piped straight into the next step in the pipeline are never written to disk, so don't waste
+# time compressing them
+INTERMEDIATE_COMPRESSION = 0
+
+# intermediate BAM files which are written to disk are only read once, so use the fastest compression, rather than
+# writing them uncompressed (which is 3-4x larger)
+TEMPORARY_COMPRESSION = 1
+
 # the minimum phred scaled genotype quality (30 = 99.9%)
 MIN_GENOTYPE_QUAL = 30
 
@@ -118,20 +129,97 @@ MIN_COVERAGE_DEPTH = 8
 # the maximum number of ancestral populatons to run admiture for
 MAX_ANCESTRAL_K = 10
 
+# the number of cores to allocate to each multi-threaded task (e.g. bwa, samtools, GATK)
+THREADS_PER_TASK = 4
+
 # no single worker should use more than 50% of the available cores
-MAX_CPU_CORES = int(multiprocessing.cpu_count() * 0.5)
+MAX_CPU_CORES = max(1, min(THREADS_PER_TASK, multiprocessing.cpu_count() // 2))
+
+# divide the cores between luigi workers, so that independent samples can be processed concurrently (n.b. this is only
+# the default when running pipeline_gatk.py directly, with `luigi --module` pass --workers instead, see README)
+CONCURRENT_WORKERS = max(1, multiprocessing.cpu_count() // MAX_CPU_CORES)
+
+# scatter variant calling across this many chunks of the targets list (n.b. the chunk files are keyed by this number,
+# so it's safe for it to change between hosts)
+INTERVAL_CHUNKS = MAX_CPU_CORES
 
 # size of buffer around indels in which to drop sites
 INDEL_BUFFER = 10
 
+# the number of ref and alt alleles in each diploid genotype, both unphased (/) and phased (|)
+GENOTYPE_CALLS = {
+    '0/0': (2, 0), '0/1': (1, 1), '1/0': (1, 1), '1/1': (0, 2),
+    '0|0': (2, 0), '0|1': (1, 1), '1|0': (1, 1), '1|1': (0, 2),
+}
+
+# the VCF notations for sites without an alternative allele (GATK gVCFs use <NON_REF> for reference blocks)
+NO_ALT_ALLELE = ('<NON_REF>', '.')
+
+# short read aligners, in order of preference, which all produce the same alignments as `bwa mem`
+#   - BWA-MEME uses a learned index and AVX-512 kernels (so it is only worth using on AVX-512 hosts)
+#   - bwa-mem2 dispatches to the widest SIMD instruction set the CPU supports
+ALIGNERS = [
+    {
+        'bin': 'bwa-meme',
+        'cpu_flag': 'avx512bw',
+        'index': ['index', '-a', 'meme'],
+        'train': ['build_rmis_dna.sh'],  # trains the learned index
+        'mem': ['mem', '-7'],            # use the learned index
+        'extensions': ['0123', 'amb', 'ann', 'pac', 'pos_packed', 'suffixarray_uint64',
+                       'suffixarray_uint64_L0_PARAMETERS', 'suffixarray_uint64_L1_PARAMETERS',
+                       'suffixarray_uint64_L2_PARAMETERS'],
+    },
+    {
+        'bin': 'bwa-mem2',
+        'cpu_flag': None,
+        'index': ['index'],
+        'train': None,
+        'mem': ['mem'],
+        'extensions': ['0123', 'amb', 'ann', 'bwt.2bit.64', 'pac'],
+    },
+    {
+        'bin': 'bwa',
+        'cpu_flag': None,
+        'index': ['index', '-a', 'bwtsw'],  # algorithm suitable for mammals
+        'train': None,
+        'mem': ['mem'],
+        'extensions': ['amb', 'ann', 'bwt', 'pac', 'sa'],
+    },
+]
+
 # location of software tools
 PICARD = "/usr/local/picard-tools-2.5.0/picard.jar"
 GATK = "/usr/local/GenomeAnalysisTK-3.6/GenomeAnalysisTK.jar"
-SAMTOOLS = "/usr/local/bin/samtools1.3"
+SAMTOOLS = "/usr/local/bin/samtools1.9"  # markdup needs >= 1.7
 
 # how many iterations to use to optimise params
 DADI_MAX_ITER = 100
 
+# the value the differential evolution optimiser assigns to params which produce an invalid model
+DADI_DE_PENALTY = 1e100
+
+# the number of model spectra to cache in each worker, and the significant figures of the params used to look them up
+# (n.b. this must be relative precision, as the optimiser's finite difference steps are tiny for params near zero)
+DADI_CACHE_SIZE = 4096
+DADI_CACHE_SIG_FIGS = 12
+
+# search on an extrapolation grid this many times coarser, then refine the top K fits on the full grid
+DADI_COARSE_FACTOR = 3
+DADI_REFINE_TOP_K = 10
+
+# the top three fits have converged once they agree to within these tolerances (log likelihood, and param spread)
+DADI_LL_TOL = 0.05
+DADI_PARAM_TOL = 0.01
+
+# stop each replicate this many iterations after its top fits converge (n.b. every iteration is seeded from the best fit
+# so far, so the top fits agree long before the search is exhausted, hence this is off by default and each replicate
+# runs all DADI_MAX_ITER iterations)
+DADI_CONVERGED_EXTRA_ITER = None
+
+# narrow the search bounds to this many standard deviations around the best fits, resetting them every N iterations
+DADI_BOUNDS_SIGMA = 3
+DADI_BOUNDS_RESET = 10
+
 # VCF column headers
 CHROM = 0
 POS = 1
@@ -5,17 +5,52 @@
 import matplotlib; matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import luigi, dadi, numpy, pylab, random
-import pickle
+import multiprocessing
+import gc
+import heapq
 import csv
 
 # import the custom pipelines
 from pipeline_gatk import *
 from pipeline_utils import *
 
-# buffer the logs created by dadi so we can inspect them
-log_buffer = LogBuffer()
+# flag the masked model warnings created by dadi so we can inspect them
+masked_filter = MaskedFilter()
 logger = logging.getLogger('Inference')
-logger.addHandler(logging.StreamHandler(log_buffer))
+logger.addFilter(masked_filter)
+
+class VariantSites(luigi.Task):
+    """
+    Extract the allele counts for all the usable sites in a population, so that populations shared by several groups
+    only need parsing once
+    """
+    population = luigi.Parameter()
+    samples = luigi.ListParameter()
+    genome = luigi.Parameter()
+
+    def requires(self):
+        return GatkGenotypeGVCFs(self.population, self.samples, self.genome)
+
+    def output(self):
+        return luigi.LocalTarget("vcf/{0}.sites.npz".format(self.population))
+
+    def run(self):
+
+        # log the summary of the rejected sites to file (use logging.DEBUG to log every single rejected site)
+        with log_to_file("vcf/{0}.sites.log".format(self.population), logging.INFO):
+
+            # parsing creates millions of short lived lists, but no reference cycles, so the garbage collector would
+            # only waste time scanning them
+            gc.disable()
+            try:
+                chroms, sites, refs, alts, counts = extract_variant_sites(self.population, self.samples)
+            finally:
+                gc.enable()
+
+        # save the sites as numpy arrays (n.b. savez would add an extension to a path, so give it an open file instead)
+        with self.output().temporary_path() as sites_path, open(sites_path, 'wb') as fout:
+            numpy.savez(fout, chroms=chroms, sites=sites, refs=refs, alts=alts, counts=counts)
+
 
 class SiteFrequencySpectrum(luigi.Task):
     """
@@ -25,23 +60,48 @@ class SiteFrequencySpectrum(luigi.Task):
     genome = luigi.Parameter()
 
     def requires(self):
-        for population, samples in GROUPS[self.group].iteritems():
-            yield GatkGenotypeGVCFs(population, samples, self.genome)
+        return dict((population, VariantSites(population, samples, self.genome))
+                    for population, samples in GROUPS[self.group].iteritems())
 
     def output(self):
         return luigi.LocalTarget("fsdata/{0}.data".format(self.group))
 
     def run(self):
 
-        # log everything to file
-        logging.basicConfig(filename="fsdata/{0}.log".format(self.group), level=logging.DEBUG)
+        # load the sites extracted from each population
+        populations = dict()
 
-        # generate the frequency spectrum
-        fsdata = generate_frequency_spectrum(GROUPS[self.group])
+        for population, target in self.input().iteritems():
+            sites = numpy.load(target.path)
+            populations[population] = tuple(sites[col] for col in ['chroms', 'sites', 'refs', 'alts', 'counts'])
 
-        # save the fsdata file
-        with self.output().open('w') as fout:
-            fout.write(fsdata)
+        # generate the frequency spectrum, and stream it into the fsdata file
+        with self.output().temporary_path() as fsdata_path, open(fsdata_path, 'w', IO_BUFFER_SIZE) as fout:
+            generate_frequency_spectrum(populations, fout)
+
+
+class DadiDataDict(luigi.Task):
+    """
+    Parse the fsdata file into arrays of allele counts, once per group, so the spectrum for each pair of populations
+    doesn't need to reparse the whole text file
+    """
+    group = luigi.Parameter()
+    genome = luigi.Parameter()
+
+    def requires(self):
+        return SiteFrequencySpectrum(self.group, self.genome)
+
+    def output(self):
+        return luigi.LocalTarget("fsdata/{0}.dd.npz".format(self.group))
+
+    def run(self):
+
+        # parse the data file into columns of called and derived allele counts
+        pops, called, derived, polarised = parse_fsdata(self.input().path)
+
+        # write to an open file, otherwise numpy appends .npz to the temporary path
+        with self.output().temporary_path() as dd_path, open(dd_path, 'wb') as fout:
+            numpy.savez_compressed(fout, pops=pops, called=called, derived=derived, polarised=polarised)
 
 
 class DadiSpectrum(luigi.Task):
@@ -54,7 +114,7 @@ class DadiSpectrum(luigi.Task):
     polarised = luigi.BoolParameter()
 
     def requires(self):
-        return SiteFrequencySpectrum(self.group, GENOME)
+        return DadiDataDict(self.group, GENOME)
 
     def output(self):
         polar = '_folded' if not self.polarised else ''
@@ -62,8 +122,8 @@ class DadiSpectrum(luigi.Task):
 
     def run(self):
 
-        # parse the data file to generate the data dictionary
-        dd = dadi.Misc.make_data_dict(self.input().path)
+        # load the allele count arrays
+        data = numpy.load(self.input().path)
 
         # get the two populations
         pops = [self.pop1, self.pop2]
@@ -71,213 +131,755 @@ class DadiSpectrum(luigi.Task):
         # project each population down by one sample to allow for a little missing coverage
         prj = [(len(GROUPS[self.group][pop]) - 1) * 2 for pop in pops]
 
-        # extract the spectrum for the two populations from the dictionary and project down
-        fs = dadi.Spectrum.from_data_dict(dd, pops, prj, polarized=self.polarised)
+        # extract the spectrum for the two populations from the arrays and project down
+        fs = spectrum_from_counts(data, pops, prj, self.polarised)
 
         # save it to a file
-        fs.to_file(self.output().path)
+        with self.output().temporary_path() as fs_path:
+            fs.to_file(fs_path)
 
 
-class DadiModelOptimizeParams(PrioritisedTask):
+def parse_fsdata(path):
     """
-    Optimise the log likelihood of the model paramaters for the given frequency spectrum
+    Parse an fsdata file into numpy arrays, as an equivalent to dadi.Misc.make_data_dict which builds a dictionary
+    for every single site
+
+    :param path: Path to the fsdata file
+    :return: Tuple of (pops, called, derived, polarised), with one row per site and one column per population
     """
-    group = luigi.Parameter()
-    pop1 = luigi.Parameter()
-    pop2 = luigi.Parameter()
+    with open(path, 'r', IO_BUFFER_SIZE) as fin:
 
-    polarised = luigi.BoolParameter()
-    model = luigi.Parameter()
-    scenario = luigi.Parameter()
-    grid_size = luigi.ListParameter()
-    upper_bound = luigi.ListParameter()
-    lower_bound = luigi.ListParameter()
-    fixed_params = luigi.ListParameter()
-    param_start = luigi.ListParameter(significant=False)
+        # skip the comments to get the header
+        header = fin.readline()
+        while header.startswith('#'):
+            header = fin.readline()
 
-    n = luigi.IntParameter()
+        header = header.split()
+        allele2_idx = header.index('Allele2')
+        pops = header[3:allele2_idx]
 
-    def requires(self):
-        return DadiSpectrum(self.group, self.pop1, self.pop2, self.polarised)
+        # split the whole file in one go (n.b. generate_frequency_spectrum only writes comments before the header)
+        cols = numpy.array(fin.read().split()).reshape(-1, len(header))
 
-    def output(self):
-        return luigi.LocalTarget("fsdata/opt/{0}_{1}_{2}_{3}_{4}_{5}.opt".format(self.group, self.pop1, self.pop2,
-                                                                                 self.model, self.scenario, self.n))
+    # the outgroup allele is the middle base of the outgroup context
+    outgroup = numpy.char.upper(cols[:, 1].astype('S3')).view('S1').reshape(-1, 3)[:, 1]
+    allele1 = numpy.char.upper(cols[:, 2])
+    allele2 = numpy.char.upper(cols[:, allele2_idx])
 
-    def run(self):
+    # same rules as dadi.Misc.count_data_dict, sites are only polarised when the outgroup matches a segregating allele
+    polarised = (outgroup != '-') & ((outgroup == allele1) | (outgroup == allele2))
 
-        # load the frequency spectrum
-        fs = dadi.Spectrum.from_file(self.input().path)
-        ns = fs.sample_sizes
+    # unpolarised sites treat the first allele as ancestral
+    ancestral1 = numpy.where(polarised, outgroup == allele1, True)
 
-        # get the demographic model to test
-        func = getattr(dadi.Demographics2D, self.model)
+    calls1 = cols[:, 3:allele2_idx].astype(numpy.int32)
+    calls2 = cols[:, allele2_idx + 1:allele2_idx + 1 + len(pops)].astype(numpy.int32)
 
-        # Make the extrapolating version of our demographic model function.
-        func_ex = dadi.Numerics.make_extrap_log_func(func)
+    called = calls1 + calls2
+    derived = numpy.where(ancestral1[:, numpy.newaxis], calls2, calls1)
 
-        # keep a list of the optimal params
-        p_best = []
+    return numpy.array(pops), called, derived, polarised
 
-        # start with the random values passed to this task
-        p_start = self.param_start
 
-        # run the optimisation many times
-        for i in range(0, DADI_MAX_ITER):
+def spectrum_from_counts(data, pops, projections, polarised):
+    """
+    Build a projected spectrum from the arrays made by parse_fsdata, as an equivalent to dadi.Spectrum.from_data_dict
 
-            # Perturb our parameters before optimization. This does so by taking each
-            # parameter a up to a factor of two up or down.
-            p_perturb = dadi.Misc.perturb_params(p_start,
-                                                 fold=1,
-                                                 upper_bound=self.upper_bound,
-                                                 lower_bound=self.lower_bound)
+    :param data: Dictionary of the arrays returned by parse_fsdata
+    :param pops: List of populations to make the spectrum for
+    :param projections: List of sample sizes to project down to for each population
+    :param polarised: Only use the polarised sites, otherwise use all sites and fold the spectrum
+    :return: dadi.Spectrum
+    """
+    pop_ids = list(data['pops'])
+    idx = [pop_ids.index(pop) for pop in pops]
 
-            # enforce any fixed params
-            if self.fixed_params:
-                for j in range(0, len(self.fixed_params)):
-                    if self.fixed_params[j] is not None:
-                        p_perturb[j] = self.fixed_params[j]
+    called = data['called'][:, idx]
+    derived = data['derived'][:, idx]
 
-            print('Started optimization: {:<12} | {:<8} | {:<8} | {:<9} | {:<15} | n={:>3} | i={:>3} |'.format(
-                self.group, self.pop1, self.pop2, self.model, self.scenario, self.n, i))
+    if polarised:
+        # only the polarised sites can be used (same as dadi)
+        called = called[data['polarised']]
+        derived = derived[data['polarised']]
 
-            start = datetime.datetime.now()
+    # collapse the sites into their unique configurations, as the projection only needs to be done once for each
+    configs, counts = numpy.unique(numpy.hstack((called, derived)), axis=0, return_counts=True)
 
-            # do the optimization...
-            p_opt = dadi.Inference.optimize_log(p_perturb, fs, func_ex, self.grid_size,
-                                                lower_bound=self.lower_bound,
-                                                upper_bound=self.upper_bound,
-                                                fixed_params=self.fixed_params,
-                                                verbose=20,
-                                                maxiter=DADI_MAX_ITER)
+    # project each population down, and take the outer product of their contributions to the spectrum
+    n = len(pops)
+    fs = counts[:, numpy.newaxis].astype(numpy.float64)
 
-            end = datetime.datetime.now()
-            diff = (end - start).total_seconds() / 60
+    for j, proj in enumerate(projections):
+        contrib = project_counts(configs[:, j], configs[:, n + j], proj)
+        fs = (fs[:, :, numpy.newaxis] * contrib[:, numpy.newaxis, :]).reshape(len(configs), -1)
 
-            print('Finshed optimization: {:<12} | {:<8} | {:<8} | {:<9} | {:<15} | n={:>3} | i={:>3} | t={:>3.1f} mins'.format(
-                self.group, self.pop1, self.pop2, self.model, self.scenario, self.n, i, diff))
+    fs = dadi.Spectrum(fs.sum(axis=0).reshape([proj + 1 for proj in projections]), mask_corners=True, pop_ids=pops)
 
-            # reset the log buffer
-            log_buffer.log = []
+    if not polarised:
+        fs = fs.fold()
+        fs.mask_corners()
 
-            # Calculate the best-fit model AFS.
-            model = func_ex(p_opt, ns, self.grid_size)
+    return fs
 
-            # Likelihood of the data given the model AFS.
-            ll_model = dadi.Inference.ll_multinom(model, fs)
 
-            # The optimal value of theta given the model.
-            theta = dadi.Inference.optimal_sfs_scaling(model, fs)
+def project_counts(called, derived, proj):
+    """
+    The hypergeometric probabilities of sampling each number of derived alleles when projecting down to a smaller
+    sample size (the same as dadi's projection, but for all the sites at once)
 
-            # get the buffered warnings
-            warnings = " ".join(log_buffer.log)
+    :param called: Array of the number of called alleles at each site
+    :param derived: Array of the number of derived alleles at each site
+    :param proj: The sample size to project down to
+    :return: Array with one row per site, and one column for each number of derived alleles in the projection
+    """
+    # the log factorials of all the sample sizes, so we can look up the log of n choose k
+    n_max = max(proj, called.max() if called.size else 0)
+    lnfact = numpy.concatenate(([0.0], numpy.cumsum(numpy.log(numpy.arange(1, n_max + 1)))))
 
-            # we only care about non-masked data
-            if "Model is masked" not in warnings:
+    def lncomb(n, k):
+        valid = (k >= 0) & (k <= n)
+        return numpy.where(valid, lnfact[n] - lnfact[numpy.clip(k, 0, n)] - lnfact[numpy.clip(n - k, 0, n)], -numpy.inf)
 
-                print('Maximum log composite likelihood: {0}'.format(ll_model))
-                print('Optimal value of theta: {0}'.format(theta))
+    called = called[:, numpy.newaxis]
+    derived = derived[:, numpy.newaxis]
+    hits = numpy.arange(proj + 1)
 
-                # record the best fitting params for this run
-                p_best.append([ll_model, theta] + list(p_opt))
+    # sites with fewer calls than the projection don't contribute at all
+    with numpy.errstate(invalid='ignore'):
+        lncontrib = lncomb(proj, hits) + lncomb(numpy.maximum(called - proj, 0), derived - hits) \
+                    - lncomb(called, derived)
 
-                # sort the params (largest ll_model first)
-                p_best.sort(reverse=True)
+    return numpy.where(called >= proj, numpy.exp(lncontrib), 0.0)
 
-            try:
-                # run the optimisation again, starting from the best fit we've seen so far
-                p_start = p_best[0][2:]
-            except IndexError:
-                # otherwise, generate a set of new random starting params (so we don't get stuck in bad param space)
-                p_start = random_params(self.lower_bound, self.upper_bound, self.fixed_params)
 
-        # if we've run the iteration DADI_MAX_ITER times and not found any non-masked params then we've failed
-        if not p_best:
-            raise Exception("{} | {} | {} | n={}: FAILED to find any non-masked params".format(self.group,
-                                                                                               self.model,
-                                                                                               self.scenario,
-                                                                                               self.n))
-        # save the list of optimal params by pickeling them in a file
-        with self.output().open('w') as fout:
-            pickle.dump(p_best, fout)
+# the arguments shared by all the replicates in the current batch, which are inherited by the pool workers when they
+# are forked
+worker_args = ()
+
+
+def init_worker(*args):
+    """
+    Initialise a pool worker with the arguments shared by all the replicates in the batch
+
+    :param args: Tuple of the optimiser function, the frequency spectrum and the engine
+    """
+    global worker_args
+    worker_args = args
+
+    # reseed each worker process, otherwise they all inherit the same random state from the parent process
+    random.seed()
+    numpy.random.seed()
+
+
+@memoize
+def worker_func_ex(model_name, engine):
+    """
+    Build the model function in a pool worker (func_ex is a closure, so it can't be pickled and sent with each job),
+    with its own cache of results, which lasts for all the replicates of that model run by the worker
+    """
+    return memoize_model(build_func_ex(model_name, engine))
+
+
+def optimize_replicate(job):
+    """
+    Run one replicate of the optimisation in a pool worker, using the arguments given to init_worker()
+
+    :param job: Tuple of the replicate index, the model name, and the remaining arguments to the optimiser
+    :return: Tuple of the replicate index, the list of optimal params, and the data and mask of the best-fit model AFS
+    """
+    optimizer, fs, engine = worker_args
+
+    func_ex = worker_func_ex(job[1], engine)
+
+    # count the masked model warnings for this replicate
+    masked_filter.count = 0
+
+    # the optimiser returns the best-fit model AFS too, as it may have been evicted from the worker's cache since
+    p_best, model = optimizer(fs, func_ex, *job[2:])
+
+    if masked_filter.count:
+        print('Masked model warnings: {} | {} warnings |'.format(job[-1], masked_filter.count))
+
+    return job[0], p_best, numpy.ma.getdata(model), numpy.ma.getmaskarray(model)
+
 
+def evaluate_params(fs, func_ex, grid_size, p_opt):
+    """
+    Calculate the log likelihood and optimal theta of the best-fit model AFS for the given params
+
+    :return: Tuple of (ll_model, theta, masked, model)
+    """
+    # reset the masked flag
+    masked_filter.masked = False
+
+    # Calculate the best-fit model AFS.
+    model = func_ex(p_opt, fs.sample_sizes, grid_size)
+
+    # The optimal value of theta given the model.
+    theta = dadi.Inference.optimal_sfs_scaling(model, fs)
+
+    # Likelihood of the data given the model AFS (this is what ll_multinom does, but without rescaling it again)
+    ll_model = dadi.Inference.ll(theta * model, fs)
+
+    return ll_model, theta, masked_filter.masked, model
+
+
+@memoize
+def load_spectrum(path):
+    """
+    Load a frequency spectrum file, once per process, as sibling tasks often share the same spectrum
+
+    n.b. the spectrum is shared, so it must not be modified
+    """
+    return dadi.Spectrum.from_file(path)
+
+
+@memoize
+def build_func_ex(model_name, engine='dadi'):
+    """
+    Make the extrapolating version of the named demographic model function, once per process
+
+    :param engine: Which engine to compute the model AFS with (see ENGINES)
+    :return: The model function, called as func_ex(params, ns, pts)
+    """
+    if engine == 'moments':
+        # moments is optional, so only import it if we need it
+        import moments
+
+        # moments solves the moment equations directly, so it doesn't need a grid (or extrapolation)
+        func = getattr(moments.Demographics2D, model_name)
+
+        def func_ex(params, ns, pts):
+            return func(params, ns)
+
+        return func_ex
+
+    # get the demographic model to test
+    func = getattr(dadi.Demographics2D, model_name)
+
+    return dadi.Numerics.make_extrap_log_func(func)
+
+
+# the engines which can compute the model AFS (moments has the same 2D models as dadi)
+ENGINES = ['dadi', 'moments']
+
+
+def has_converged(p_best):
+    """
+    Check if the top three fits agree, both in their log likelihoods and in their params
+
+    :param p_best: List of [ll_model, theta] + p_opt (largest ll_model first)
+    """
+    top = numpy.array(p_best[:3])
+
+    if len(top) < 3 or top[0, 0] - top[2, 0] > DADI_LL_TOL:
+        return False
+
+    # the spread of each param, relative to the best fit (n.b. some params may legitimately be zero)
+    spread = numpy.ptp(top[:, 2:], axis=0) / numpy.maximum(numpy.abs(top[0, 2:]), 1e-12)
+
+    return spread.max() < DADI_PARAM_TOL
+
+
+def trust_region(p_best, lower_bound, upper_bound):
+    """
+    Shrink the bounds to the region around the best fits so far (mean +/- DADI_BOUNDS_SIGMA standard deviations),
+    so that we don't keep searching regions of param space that have already been ruled out
 
-class DadiModelMaximumLikelihood(luigi.Task):
+    :param p_best: List of [ll_model, theta] + p_opt
+    :return: Tuple of the (lower, upper) bounds
     """
-    Find the maximum log likelihood parameters for a given model, and plot the resulting spectrum
+    params = numpy.array(p_best)[:, 2:]
+
+    mu = params.mean(axis=0)
+    sigma = params.std(axis=0)
+
+    # don't collapse the bounds of any params which haven't varied (e.g. fixed params)
+    lower = numpy.where(sigma > 0, numpy.maximum(lower_bound, mu - DADI_BOUNDS_SIGMA * sigma), lower_bound)
+    upper = numpy.where(sigma > 0, numpy.minimum(upper_bound, mu + DADI_BOUNDS_SIGMA * sigma), upper_bound)
+
+    return lower.tolist(), upper.tolist()
+
+
+def optimize_params(fs, func_ex, grid_size, upper_bound, lower_bound, fixed_params, param_start, label):
+    """
+    Optimise the log likelihood of the model paramaters for the given frequency spectrum, starting from the given
+    params and reseeding each subsequent iteration from the best fit found so far
+
+    The search is done on a coarse grid (the PDE cost grows with the cube of the grid size), and only the best fits
+    are then refined on the full grid.
+
+    This is a pure function, so that the replicates can be run in a pool of worker processes.
+
+    :return: Tuple of the list of [ll_model, theta] + p_opt for the refined non-masked optimisations (largest ll_model
+             first), and the best-fit model AFS
+    """
+    # shrink the extrapolation grid for the exploratory search
+    coarse_grid = [max(min(grid_size), pts // DADI_COARSE_FACTOR) for pts in grid_size]
+
+    # keep a min-heap of the best fitting params (we only need enough of them to check convergence and to refine)
+    p_best = []
+    p_keep = max(DADI_REFINE_TOP_K, 3)
+
+    # start with the random values passed to this replicate
+    p_start = param_start
+
+    # the iteration at which the top fits converged
+    converged = None
+
+    # the indices and values of any fixed params
+    fixed = [j for j, val in enumerate(fixed_params or []) if val is not None]
+    fixed_vals = [fixed_params[j] for j in fixed]
+
+    # run the optimisation many times
+    for i in range(0, DADI_MAX_ITER):
+
+        # narrow the search to the region around the best fits so far (except every so often, so we don't get stuck)
+        if len(p_best) == p_keep and i % DADI_BOUNDS_RESET:
+            lower, upper = trust_region(p_best, lower_bound, upper_bound)
+        else:
+            lower, upper = lower_bound, upper_bound
+
+        # Perturb our parameters before optimization. This does so by taking each
+        # parameter a up to a factor of two up or down.
+        p_perturb = dadi.Misc.perturb_params(p_start,
+                                             fold=1,
+                                             upper_bound=upper,
+                                             lower_bound=lower)
+
+        # enforce any fixed params (perturb_params returns a numpy array, so we can set them all at once)
+        p_perturb[fixed] = fixed_vals
+
+        print('Started optimization: {} | i={:>3} |'.format(label, i))
+
+        start = datetime.datetime.now()
+
+        # do the optimization...
+        p_opt = dadi.Inference.optimize_log(p_perturb, fs, func_ex, coarse_grid,
+                                            lower_bound=lower,
+                                            upper_bound=upper,
+                                            fixed_params=fixed_params,
+                                            verbose=20,
+                                            maxiter=DADI_MAX_ITER)
+
+        end = datetime.datetime.now()
+        diff = (end - start).total_seconds() / 60
+
+        print('Finshed optimization: {} | i={:>3} | t={:>3.1f} mins'.format(label, i, diff))
+
+        ll_model, theta, masked, _ = evaluate_params(fs, func_ex, coarse_grid, p_opt)
+
+        # we only care about non-masked data
+        if not masked:
+
+            print('Maximum log composite likelihood: {0}'.format(ll_model))
+            print('Optimal value of theta: {0}'.format(theta))
+
+            # record the best fitting params for this run (dropping the worst fit, once the heap is full)
+            if len(p_best) < p_keep:
+                heapq.heappush(p_best, [ll_model, theta] + list(p_opt))
+            else:
+                heapq.heappushpop(p_best, [ll_model, theta] + list(p_opt))
+
+            if converged is None and has_converged(heapq.nlargest(3, p_best)):
+                print('Converged optimization: {} | i={:>3} |'.format(label, i))
+                converged = i
+
+        # stop early (if enabled), once we've run any extra iterations past the point of convergence
+        if converged is not None and DADI_CONVERGED_EXTRA_ITER is not None \
+                and i - converged >= DADI_CONVERGED_EXTRA_ITER:
+            break
+
+        if p_best:
+            # run the optimisation again, starting from the best fit we've seen so far
+            p_start = max(p_best)[2:]
+        else:
+            # otherwise, generate a set of new random starting params (so we don't get stuck in bad param space)
+            p_start = random_params(lower_bound, upper_bound, fixed_params)
+
+    # keep a list of the refined params
+    p_refined = []
+
+    # now refine the best fits from the coarse search, using the full grid
+    for p_coarse in heapq.nlargest(DADI_REFINE_TOP_K, p_best):
+
+        p_opt = dadi.Inference.optimize_log(p_coarse[2:], fs, func_ex, grid_size,
+                                            lower_bound=lower_bound,
+                                            upper_bound=upper_bound,
+                                            fixed_params=fixed_params,
+                                            verbose=20,
+                                            maxiter=DADI_MAX_ITER)
+
+        ll_model, theta, masked, model = evaluate_params(fs, func_ex, grid_size, p_opt)
+
+        if not masked:
+            p_refined.append(([ll_model, theta] + list(p_opt), model))
+
+    # sort the params (largest ll_model first)
+    p_refined.sort(key=lambda fit: fit[0], reverse=True)
+
+    # if we've not found any non-masked params then we've failed
+    if not p_refined:
+        raise Exception("{}: FAILED to find any non-masked params".format(label))
+
+    return [fit[0] for fit in p_refined], p_refined[0][1]
+
+
+def optimize_params_de(fs, func_ex, grid_size, upper_bound, lower_bound, fixed_params, param_start, label):
+    """
+    Optimise the log likelihood of the model paramaters for the given frequency spectrum, using differential evolution
+    (a global optimiser) on the coarse grid, and then refining the result with the local optimiser on the full grid
+
+    Takes the same arguments as optimize_params(), so it can be run in the same pool of workers, but because the
+    search is global it only needs to be run once per model (see REPLICATES).
+
+    :return: Tuple of the list of [ll_model, theta] + p_opt for the non-masked params (largest ll_model first), and the
+             best-fit model AFS
+    """
+    # scipy is only needed by this optimiser, so only import it if we need it
+    import scipy.optimize
+
+    ns = fs.sample_sizes
+
+    # the global search is exploratory, so do it on the same coarse grid as optimize_params()
+    coarse_grid = [max(min(grid_size), pts // DADI_COARSE_FACTOR) for pts in grid_size]
+
+    # only search the free params, the fixed ones keep the values from the starting params
+    free = [j for j in range(len(param_start)) if not fixed_params or fixed_params[j] is None]
+
+    def expand_params(x):
+        p = list(param_start)
+        for j, val in zip(free, x):
+            p[j] = val
+        return p
+
+    def neg_ll(x):
+        ll_model = dadi.Inference.ll_multinom(func_ex(expand_params(x), ns, coarse_grid), fs)
+        # penalise invalid models with a large (but finite) value, so they still rank below every valid model
+        return -ll_model if numpy.isfinite(ll_model) else DADI_DE_PENALTY
+
+    print('Started optimization: {} |'.format(label))
+
+    start = datetime.datetime.now()
+
+    # the pool workers are reseeded by init_worker(), so each run evolves a different population
+    result = scipy.optimize.differential_evolution(neg_ll,
+                                                   bounds=[(lower_bound[j], upper_bound[j]) for j in free],
+                                                   maxiter=DADI_MAX_ITER,
+                                                   polish=False)
+
+    # refine the best fit from the global search, with the same local optimiser as optimize_params()
+    p_opt = dadi.Inference.optimize_log(expand_params(result.x), fs, func_ex, grid_size,
+                                        lower_bound=lower_bound,
+                                        upper_bound=upper_bound,
+                                        fixed_params=fixed_params,
+                                        verbose=20,
+                                        maxiter=DADI_MAX_ITER)
+
+    end = datetime.datetime.now()
+    diff = (end - start).total_seconds() / 60
+
+    print('Finshed optimization: {} | t={:>3.1f} mins'.format(label, diff))
+
+    # keep the unrefined fit too, in case the local optimiser wandered off into masked param space
+    p_refined = []
+
+    for p in [list(p_opt), expand_params(result.x)]:
+        ll_model, theta, masked, model = evaluate_params(fs, func_ex, grid_size, p)
+
+        if not masked:
+            p_refined.append(([ll_model, theta] + p, model))
+
+    if not p_refined:
+        raise Exception("{}: FAILED to find any non-masked params".format(label))
+
+    # sort the params (largest ll_model first)
+    p_refined.sort(key=lambda fit: fit[0], reverse=True)
+
+    print('Maximum log composite likelihood: {0}'.format(p_refined[0][0][0]))
+    print('Optimal value of theta: {0}'.format(p_refined[0][0][1]))
+
+    return [fit[0] for fit in p_refined], p_refined[0][1]
+
+
+# the functions for each of the optimisers, which all take the same arguments
+OPTIMIZERS = {
+    'bfgs': optimize_params,
+    'de': optimize_params_de,
+}
+
+# the number of replicates to run for each of the optimisers (differential evolution is a global search, so repeating
+# it from different random starting params would be a waste)
+REPLICATES = {
+    'bfgs': DADI_MAX_ITER,
+    'de': 1,
+}
+
+
+def results_suffix(optimizer, engine):
+    """
+    The file name suffix for the results of the given optimiser and engine (none for the defaults)
+    """
+    return ''.join('_' + name for name in [optimizer, engine] if name not in ['bfgs', 'dadi'])
+
+
+def replicate_targets(group, pop1, pop2, model, scenario, optimizer, engine):
+    """
+    The output files of the optimisation, one file per replicate, so a failed batch can resume where it left off
+    """
+    suffix = results_suffix(optimizer, engine)
+
+    return [luigi.LocalTarget("fsdata/opt/{0}_{1}_{2}_{3}_{4}{5}_{6}.npz".format(group, pop1, pop2, model, scenario,
+                                                                                 suffix, n))
+            for n in range(0, REPLICATES[optimizer])]
+
+
+def likelihood_targets(group, pop1, pop2, model, scenario, optimizer, engine, plot):
+    """
+    The output files of the maximum likelihood search, the csv of all the fits and the plot of the best one
+    """
+    suffix = results_suffix(optimizer, engine)
+
+    yield luigi.LocalTarget("fsdata/{0}_{1}_{2}_{3}_{4}{5}.csv".format(group, pop1, pop2, model, scenario, suffix))
+
+    if plot:
+        yield luigi.LocalTarget("fsdata/{0}_{1}_{2}_{3}_{4}{5}.pdf".format(group, pop1, pop2, model, scenario, suffix))
+
+
+def queue_replicates(jobs, targets, outputs, label, model, grid_size, upper_bound, lower_bound, fixed_params):
+    """
+    Queue a job for each of the replicates which haven't finished yet
+
+    :param jobs: List of the queued jobs (appended to)
+    :param targets: List of the output targets of the queued jobs (appended to)
+    :param outputs: The output targets of all the replicates
+    :param label: The label to print for the replicates
+    """
+    # make some random starting params for all the replicates
+    param_starts = random_params(lower_bound, upper_bound, fixed_params, size=len(outputs))
+
+    for n, opt in enumerate(outputs):
+        # only run the replicates which haven't finished yet
+        if opt.exists():
+            continue
+
+        jobs.append((len(targets), model, grid_size, upper_bound, lower_bound, fixed_params, param_starts[n],
+                     '{} | n={:>3}'.format(label, n)))
+        targets.append(opt)
+
+
+def run_replicates(fs, optimizer, engine, processes, jobs, targets):
+    """
+    Run the queued replicates in a pool of worker processes, saving each one as soon as it finishes
+    """
+    # the frequency spectrum is shared with all the workers (it is inherited when the pool forks)
+    pool = multiprocessing.Pool(processes, init_worker, (OPTIMIZERS[optimizer], fs, engine))
+
+    try:
+        # save each replicate as soon as it finishes, so a slow replicate doesn't hold up the others
+        for i, p_best, best_afs, best_mask in pool.imap_unordered(optimize_replicate, jobs):
+
+            # save the optimal params as a numpy array, along with the best-fit model AFS so we can plot it without
+            # solving the model again (n.b. savez would add an extension to a path, so give it an open file instead)
+            with targets[i].temporary_path() as opt_path, open(opt_path, 'wb') as fout:
+                numpy.savez(fout, p_best=numpy.asarray(p_best, dtype=numpy.float64), best_afs=best_afs,
+                            best_mask=best_mask)
+
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def save_likelihoods(opts, targets, param_names, fs_path):
+    """
+    Find the maximum log likelihood parameters from all the replicates, save them all to a csv, and (if there is a
+    second target) plot the resulting spectrum
+
+    :param opts: The output targets of all the replicates
+    :param targets: List of the csv target, and optionally the pdf target
+    """
+    # make a master array of optimal params, remembering which replicate each row came from
+    p_reps = [numpy.load(opt.path)['p_best'] for opt in opts]
+    p_source = numpy.repeat(numpy.arange(len(p_reps)), [len(p_rep) for p_rep in p_reps])
+    p_best = numpy.vstack(p_reps)
+
+    # sort the params (largest ll_model first)
+    p_order = numpy.argsort(-p_best[:, 0], kind='mergesort')
+    p_best = p_best[p_order]
+
+    header = ["likelihood", "theta"] + list(param_names)
+
+    # dump all the data to csv
+    with targets[0].open("w") as fout:
+        writer = csv.writer(fout)
+        writer.writerow(header)
+        writer.writerows(p_best.tolist())
+
+    if len(targets) < 2:
+        return
+
+    # load the frequency spectrum
+    fs = load_spectrum(fs_path)
+
+    # get the replicate with the maximum log likelihood, from all ~1e6 iterations
+    best = numpy.load(opts[p_source[p_order[0]]].path)
+
+    # use the best-fit model AFS saved by the replicate, so we don't need to solve the model again
+    model = dadi.Spectrum(best['best_afs'], mask=best['best_mask'])
+
+    # plot the figure
+    fig = plt.figure(1)
+    try:
+        dadi.Plotting.plot_2d_comp_multinom(model, fs, fig_num=1, vmin=1, resid_range=10)
+        fig.savefig(targets[1].path)
+    finally:
+        # don't leak the figure if plotting fails
+        plt.close(fig)
+
+
+class DadiMultiScenarioOptimize(PrioritisedTask):
+    """
+    Optimise the log likelihood of several model scenarios for the same frequency spectrum, running the replicates
+    of all the scenarios in a single pool of worker processes
+
+    Each scenario is a dictionary with the keys: model, scenario, param_names, upper_bound, lower_bound, fixed_params
     """
     group = luigi.Parameter()
     pop1 = luigi.Parameter()
     pop2 = luigi.Parameter()
 
     polarised = luigi.BoolParameter()
-    model = luigi.Parameter()
-    scenario = luigi.Parameter()
-    param_names = luigi.ListParameter()
     grid_size = luigi.ListParameter()
-    upper_bound = luigi.ListParameter()
-    lower_bound = luigi.ListParameter()
-    fixed_params = luigi.ListParameter()
+    scenarios = luigi.ListParameter()
+
+    # which optimiser to use for each replicate (see OPTIMIZERS)
+    optimizer = luigi.ChoiceParameter(choices=OPTIMIZERS.keys(), default='bfgs')
+
+    # which engine to compute the model AFS with (see ENGINES)
+    engine = luigi.ChoiceParameter(choices=ENGINES, default='dadi')
+
+    # size of the pool of worker processes (e.g. `--DadiMultiScenarioOptimize-processes 8`, or set it in luigi.cfg)
+    processes = luigi.IntParameter(default=MAX_CPU_CORES, significant=False)
 
     def requires(self):
-        for n in range(0, DADI_MAX_ITER):
-            # make some random starting params
-            param_start = random_params(self.lower_bound, self.upper_bound, self.fixed_params)
+        return DadiSpectrum(self.group, self.pop1, self.pop2, self.polarised)
 
-            # find the optimal params
-            yield DadiModelOptimizeParams(self.group, self.pop1, self.pop2, self.polarised, self.model, self.scenario,
-                                          self.grid_size,self.upper_bound, self.lower_bound, self.fixed_params,
-                                          param_start, n)
+    def output(self):
+        # one file per replicate, so a failed batch can resume where it left off
+        return [opt for s in self.scenarios
+                for opt in replicate_targets(self.group, self.pop1, self.pop2, s['model'], s['scenario'],
+                                             self.optimizer, self.engine)]
+
+    def run(self):
+
+        targets = []
+        jobs = []
+
+        # queue the replicates of all the scenarios, so that no worker sits idle waiting for the slowest scenario
+        for s in self.scenarios:
+
+            label = '{:<12} | {:<8} | {:<8} | {:<9} | {:<15}'.format(self.group, self.pop1, self.pop2, s['model'],
+                                                                    s['scenario'])
+
+            outputs = replicate_targets(self.group, self.pop1, self.pop2, s['model'], s['scenario'], self.optimizer,
+                                        self.engine)
+
+            queue_replicates(jobs, targets, outputs, label, s['model'], self.grid_size, s['upper_bound'],
+                             s['lower_bound'], s['fixed_params'])
+
+        # load the frequency spectrum once, for all the scenarios
+        run_replicates(load_spectrum(self.input().path), self.optimizer, self.engine, self.processes, jobs, targets)
+
+
+class DadiMultiScenarioLikelihood(PrioritisedTask):
+    """
+    Find the maximum log likelihood parameters for several model scenarios for the same frequency spectrum, and plot
+    the resulting spectra
+
+    Each scenario is a dictionary with the keys: model, scenario, param_names, upper_bound, lower_bound, fixed_params
+    """
+    group = luigi.Parameter()
+    pop1 = luigi.Parameter()
+    pop2 = luigi.Parameter()
+
+    polarised = luigi.BoolParameter()
+    grid_size = luigi.ListParameter()
+    scenarios = luigi.ListParameter()
+
+    # which optimiser to use for each replicate (see OPTIMIZERS)
+    optimizer = luigi.ChoiceParameter(choices=OPTIMIZERS.keys(), default='bfgs')
+
+    # which engine to compute the model AFS with (see ENGINES)
+    engine = luigi.ChoiceParameter(choices=ENGINES, default='dadi')
+
+    # plotting needs an extra model evaluation on the full grid, so make it optional (e.g. `--plot false`)
+    plot = luigi.BoolParameter(default=True, parsing=luigi.BoolParameter.EXPLICIT_PARSING)
+
+    def requires(self):
+        # find the optimal params for all the scenarios
+        return DadiMultiScenarioOptimize(self.group, self.pop1, self.pop2, self.polarised, self.grid_size,
+                                         self.scenarios, optimizer=self.optimizer, engine=self.engine)
 
     def output(self):
-        return [luigi.LocalTarget("fsdata/{0}_{1}_{2}_{3}_{4}.csv".format(self.group, self.pop1, self.pop2, self.model,
-                                                                          self.scenario)),
-                luigi.LocalTarget("fsdata/{0}_{1}_{2}_{3}_{4}.pdf".format(self.group, self.pop1, self.pop2, self.model,
-                                                                          self.scenario))]
+        return [target for s in self.scenarios
+                for target in likelihood_targets(self.group, self.pop1, self.pop2, s['model'], s['scenario'],
+                                                 self.optimizer, self.engine, self.plot)]
 
     def run(self):
 
-        # make a master list of optimal params
-        p_best = []
+        fs_path = DadiSpectrum(self.group, self.pop1, self.pop2, self.polarised).output().path
 
-        for opt in self.input():
-            with opt.open('r') as fin:
-                # unpickle the optimal params
-                p_best += pickle.load(fin)
+        for s in self.scenarios:
 
-        # sort the params (largest ll_model first)
-        p_best.sort(reverse=True)
+            targets = list(likelihood_targets(self.group, self.pop1, self.pop2, s['model'], s['scenario'],
+                                              self.optimizer, self.engine, self.plot))
 
-        header = ["likelihood", "theta"] + list(self.param_names)
+            # skip any scenarios which finished before a previous run failed
+            if all(target.exists() for target in targets):
+                continue
 
-        # dump all the data to csv
-        with self.output()[0].open("w") as fout:
-            writer = csv.writer(fout)
-            writer.writerow(header)
-            writer.writerows(p_best)
+            opts = replicate_targets(self.group, self.pop1, self.pop2, s['model'], s['scenario'], self.optimizer,
+                                     self.engine)
 
-        # get the params with the maximum log likelihood, from all ~1e6 iterations
-        p_opt = p_best[0][2:]
+            save_likelihoods(opts, targets, s['param_names'], fs_path)
 
-        # load the frequency spectrum
-        polar = '_folded' if not self.polarised else ''
-        fs = dadi.Spectrum.from_file("fsdata/{0}_{1}_{2}{3}.fs".format(self.group, self.pop1, self.pop2, polar))
-        ns = fs.sample_sizes
 
-        # get the demographic model to test
-        func = getattr(dadi.Demographics2D, self.model)
+class DadiModelMaximumLikelihood(luigi.WrapperTask):
+    """
+    Find the maximum log likelihood parameters for a given model, and plot the resulting spectrum (i.e. a batch of just
+    one scenario)
+    """
+    group = luigi.Parameter()
+    pop1 = luigi.Parameter()
+    pop2 = luigi.Parameter()
+
+    polarised = luigi.BoolParameter()
+    model = luigi.Parameter()
+    scenario = luigi.Parameter()
+    param_names = luigi.ListParameter()
+    grid_size = luigi.ListParameter()
+    upper_bound = luigi.ListParameter()
+    lower_bound = luigi.ListParameter()
+    fixed_params = luigi.ListParameter()
+
+    # which optimiser to use for each replicate (see OPTIMIZERS)
+    optimizer = luigi.ChoiceParameter(choices=OPTIMIZERS.keys(), default='bfgs')
 
-        # Make the extrapolating version of our demographic model function.
-        func_ex = dadi.Numerics.make_extrap_log_func(func)
+    # which engine to compute the model AFS with (see ENGINES)
+    engine = luigi.ChoiceParameter(choices=ENGINES, default='dadi')
 
-        # Calculate the best-fit model AFS.
-        model = func_ex(p_opt, ns, self.grid_size)
+    # plotting needs an extra model evaluation on the full grid, so make it optional (e.g. `--plot false`)
+    plot = luigi.BoolParameter(default=True, parsing=luigi.BoolParameter.EXPLICIT_PARSING)
 
-        # plot the figure
-        fig = plt.figure(1)
-        dadi.Plotting.plot_2d_comp_multinom(model, fs, fig_num=1, vmin=1, resid_range=10)
-        fig.savefig(self.output()[1].path)
-        plt.close(fig)
+    def requires(self):
+        scenario = dict(model=self.model, scenario=self.scenario, param_names=self.param_names,
+                        upper_bound=self.upper_bound, lower_bound=self.lower_bound, fixed_params=self.fixed_params)
+
+        return DadiMultiScenarioLikelihood(self.group, self.pop1, self.pop2, self.polarised, self.grid_size, [scenario],
+                                           optimizer=self.optimizer, engine=self.engine, plot=self.plot)
 
 
 class CustomDadiFoldedUnboundPipeline(luigi.WrapperTask):
@@ -293,6 +895,9 @@ class CustomDadiFoldedUnboundPipeline(luigi.WrapperTask):
             grid_size = [10, 50, 60]
             polarised = False
 
+            # run all the scenarios for this pair of populations in one batch
+            scenarios = []
+
             # ----------------------------------------------------------------------------------------------------------
 
             model = 'split_mig'
@@ -308,8 +913,8 @@ class CustomDadiFoldedUnboundPipeline(luigi.WrapperTask):
             scenario = "unbound-folded-best-fit"
             fixed_params = None
 
-            yield DadiModelMaximumLikelihood(group, pop1, pop2, polarised, model, scenario, param_names, grid_size,
-                                             upper_bound, lower_bound, fixed_params)
+            scenarios.append(dict(model=model, scenario=scenario, param_names=param_names,
+                                  upper_bound=upper_bound, lower_bound=lower_bound, fixed_params=fixed_params))
 
             # ----------------------------------------------------------------------------------------------------------
 
@@ -328,8 +933,10 @@ class CustomDadiFoldedUnboundPipeline(luigi.WrapperTask):
             scenario = "folded-best-fit"
             fixed_params = None
 
-            yield DadiModelMaximumLikelihood(group, pop1, pop2, polarised, model, scenario, param_names, grid_size,
-                                             upper_bound, lower_bound, fixed_params)
+            scenarios.append(dict(model=model, scenario=scenario, param_names=param_names,
+                                  upper_bound=upper_bound, lower_bound=lower_bound, fixed_params=fixed_params))
+
+            yield DadiMultiScenarioLikelihood(group, pop1, pop2, polarised, grid_size, scenarios)
 
 class CustomDadiFoldedPipeline(luigi.WrapperTask):
     """
@@ -344,6 +951,9 @@ class CustomDadiFoldedPipeline(luigi.WrapperTask):
             grid_size = [10, 50, 60]
             polarised = False
 
+            # run all the scenarios for this pair of populations in one batch
+            scenarios = []
+
             # ----------------------------------------------------------------------------------------------------------
 
             model = 'split_mig'
@@ -359,8 +969,8 @@ class CustomDadiFoldedPipeline(luigi.WrapperTask):
             scenario = "folded-best-fit"
             fixed_params = None
 
-            yield DadiModelMaximumLikelihood(group, pop1, pop2, polarised, model, scenario, param_names, grid_size,
-                                             upper_bound, lower_bound, fixed_params)
+            scenarios.append(dict(model=model, scenario=scenario, param_names=param_names,
+                                  upper_bound=upper_bound, lower_bound=lower_bound, fixed_params=fixed_params))
 
             # ----------------------------------------------------------------------------------------------------------
 
@@ -379,8 +989,10 @@ class CustomDadiFoldedPipeline(luigi.WrapperTask):
             scenario = "folded-best-fit"
             fixed_params = None
 
-            yield DadiModelMaximumLikelihood(group, pop1, pop2, polarised, model, scenario, param_names, grid_size,
-                                             upper_bound, lower_bound, fixed_params)
+            scenarios.append(dict(model=model, scenario=scenario, param_names=param_names,
+                                  upper_bound=upper_bound, lower_bound=lower_bound, fixed_params=fixed_params))
+
+            yield DadiMultiScenarioLikelihood(group, pop1, pop2, polarised, grid_size, scenarios)
 
 
 class CustomDadiPipeline(luigi.WrapperTask):
@@ -402,6 +1014,9 @@ class CustomDadiPipeline(luigi.WrapperTask):
             grid_size = [10, 50, 60]
             polarised = True
 
+            # run all the scenarios for this pair of populations in one batch
+            scenarios = []
+
             # ----------------------------------------------------------------------------------------------------------
 
             model = 'split_mig'
@@ -417,8 +1032,8 @@ class CustomDadiPipeline(luigi.WrapperTask):
             scenario = "best-fit"
             fixed_params = None
 
-            yield DadiModelMaximumLikelihood(group, pop1, pop2, polarised, model, scenario, param_names, grid_size,
-                                             upper_bound, lower_bound, fixed_params)
+            scenarios.append(dict(model=model, scenario=scenario, param_names=param_names,
+                                  upper_bound=upper_bound, lower_bound=lower_bound, fixed_params=fixed_params))
 
             # ----------------------------------------------------------------------------------------------------------
 
@@ -437,8 +1052,8 @@ class CustomDadiPipeline(luigi.WrapperTask):
             scenario = "best-fit"
             fixed_params = None
 
-            yield DadiModelMaximumLikelihood(group, pop1, pop2, polarised, model, scenario, param_names, grid_size,
-                                             upper_bound, lower_bound, fixed_params)
+            scenarios.append(dict(model=model, scenario=scenario, param_names=param_names,
+                                  upper_bound=upper_bound, lower_bound=lower_bound, fixed_params=fixed_params))
 
             # -------------------
             # now lets run the model where we fix certain params, so we can do a direct comparison between them...
@@ -446,22 +1061,24 @@ class CustomDadiPipeline(luigi.WrapperTask):
             scenario = "fixed-S"
             fixed_params = [0.5, None, None, None, None, None]
 
-            yield DadiModelMaximumLikelihood(group, pop1, pop2, polarised, model, scenario, param_names, grid_size,
-                                             upper_bound, lower_bound, fixed_params)
+            scenarios.append(dict(model=model, scenario=scenario, param_names=param_names,
+                                  upper_bound=upper_bound, lower_bound=lower_bound, fixed_params=fixed_params))
 
             # -------------------
             # simulate a simple model, by fixing S, m12, m21
             scenario = "fixed-S-m12-m21"
             fixed_params = [0.5, None, None, None, 0, 0]
 
-            yield DadiModelMaximumLikelihood(group, pop1, pop2, polarised, model, scenario, param_names, grid_size,
-                                             upper_bound, lower_bound, fixed_params)
+            scenarios.append(dict(model=model, scenario=scenario, param_names=param_names,
+                                  upper_bound=upper_bound, lower_bound=lower_bound, fixed_params=fixed_params))
 
             # -------------------
             # simulate a simple model, by fixing m12, m21
             scenario = "fixed-m12-m21"
             fixed_params = [None, None, None, None, 0, 0]
 
-            yield DadiModelMaximumLikelihood(group, pop1, pop2, polarised, model, scenario, param_names, grid_size,
-                                             upper_bound, lower_bound, fixed_params)
+            scenarios.append(dict(model=model, scenario=scenario, param_names=param_names,
+                                  upper_bound=upper_bound, lower_bound=lower_bound, fixed_params=fixed_params))
+
+            yield DadiMultiScenarioLikelihood(group, pop1, pop2, polarised, grid_size, scenarios)
 
@@ -38,17 +38,14 @@ class EnsemblReferenceFasta(luigi.Task):
 
     def run(self):
 
-        zipfile = "fasta/{0}.fa.gz".format(self.genome)
-
         # TODO install ensembl perl API for a generic method of downloading fasta files
-        # download the gzipped fasta file of the reference genome
-        curl_download(GENOME_URL, zipfile)
-
-        # unzip the file
-        fasta = unzip_file(zipfile)
-
-        with self.output().open('w') as fout:
-            fout.write(fasta)
+        # download the gzipped fasta file of the reference genome, and unzip it on the fly
+        with self.output().temporary_path() as fasta_path:
+            run_pipe([["curl",
+                       "-s",          # download silently
+                       GENOME_URL],   # from this url
+                      unzip_cmd()],
+                     outfile=fasta_path)
 
 
 class SamtoolsFaidx(luigi.Task):
@@ -98,20 +95,26 @@ class BwaIndexBwtsw(luigi.Task):
         return EnsemblReferenceFasta(self.genome)
 
     def output(self):
-        extensions = ['amb', 'ann', 'bwt', 'pac', 'sa']
-        return [luigi.LocalTarget("fasta/{0}.fa.{1}".format(self.genome, ext)) for ext in extensions]
+        # each aligner has its own index format
+        return [luigi.LocalTarget("fasta/{0}.fa.{1}".format(self.genome, ext))
+                for ext in select_aligner()['extensions']]
 
     def run(self):
 
-        run_cmd(["bwa",
-                 "index",                              # index needed for bwa alignment
-                 "-a", "bwtsw",                        # algorithm suitable for mammals
-                 "fasta/{0}.fa".format(self.genome)])  # input file
+        bwa = select_aligner()
+
+        run_cmd([bwa['bin']]
+                + bwa['index']                           # index needed for bwa alignment
+                + ["fasta/{0}.fa".format(self.genome)])  # input file
 
+        if bwa['train']:
+            # train the learned index
+            run_cmd(bwa['train'] + ["fasta/{0}.fa".format(self.genome)])
 
-class BwaMem(luigi.Task):
+
+class SamtoolsSortBam(luigi.Task):
     """
-    Align the paired end fastq files to the reference genome
+    Align the fastq files to the reference genome, and pipe the alignments straight into samtools to sort them
     """
     sample = luigi.Parameter()
     genome = luigi.Parameter()
@@ -126,10 +129,12 @@ class BwaMem(luigi.Task):
 
     def output(self):
         suffix = "paired" if self.paired else "single"
-        return luigi.LocalTarget("sam/{0}.{1}.sam".format(self.sample, suffix))
+        return luigi.LocalTarget("bam/{0}.{1}.bam".format(self.sample, suffix))
 
     def run(self):
 
+        bwa = select_aligner()
+
         read_group = "@RG\\tID:{sample}\\tSM:{sample}".format(sample=self.sample)
 
         if self.paired:
@@ -138,153 +143,181 @@ class BwaMem(luigi.Task):
         else:
             fastq = ["fastq/{0}.fastq.gz".format(self.sample)]    # unapired
 
-        # perform the alignment
-        sam = run_cmd(["bwa",
-                       "mem",                               # align using the mem algorithm
-                       "-t", MAX_CPU_CORES,                 # number of cores
-                       "-R", read_group,                    # read group metadata
-                       "fasta/{0}.fa".format(self.genome)]  # reference genome
-                      + fastq,                              # input files
-                      returnout=True)
-
-        # save the SAM file
-        with self.output().open('w') as fout:
-            fout.write(sam)
-
-
-class SamtoolsSortBam(luigi.Task):
-    """
-    Convert an uncompressed SAM file into BAM format, and sort it
+        # write to a temporary file, so a failed run never leaves a truncated BAM behind
+        with self.output().temporary_path() as bam_path:
+            # perform the alignment, and stream the SAM output directly into the SAM -> BAM conversion and sorting
+            run_pipe([[bwa['bin']]
+                      + bwa['mem']                           # align using the mem algorithm
+                      + ["-t", MAX_CPU_CORES,                # number of cores
+                         "-R", read_group,                   # read group metadata
+                         "fasta/{0}.fa".format(self.genome)]  # reference genome
+                      + fastq,                               # input files
+
+                      # the reads are still grouped by name, so this is the cheapest place to add the mate tags
+                      [SAMTOOLS,
+                       "fixmate",
+                       "-m",                                 # add the mate score tags, needed by markdup
+                       "-O", "bam,level={0}".format(INTERMEDIATE_COMPRESSION),
+                       "-",                                  # read the SAM from stdin
+                       "-"],                                 # write the BAM to stdout
+
+                      [SAMTOOLS,
+                       "sort",                               # sort the reads
+                       "-l", TEMPORARY_COMPRESSION,          # level of compression
+                       "-@", MAX_CPU_CORES,                  # number of cores
+                       "-O", "bam",                          # output a BAM file
+                       "-o", bam_path,                       # output file
+                       "-"]])                                # read the BAM from stdin
+
+
+class SamtoolsMarkDuplicates(luigi.Task):
+    """
+    Merge the BAM files from the paired and unpaired reads, and remove PCR duplicates, so we don't overestimate coverage
     """
     sample = luigi.Parameter()
     genome = luigi.Parameter()
-    paired = luigi.BoolParameter()
 
     def requires(self):
-        return BwaMem(self.sample, self.genome, self.paired)
+        # we require both the paired an unpaired BAM files
+        return [SamtoolsSortBam(self.sample, self.genome, True),
+                SamtoolsSortBam(self.sample, self.genome, False)]
 
     def output(self):
-        suffix = "paired" if self.paired else "single"
-        return luigi.LocalTarget("bam/{0}.{1}.bam".format(self.sample, suffix))
+        return luigi.LocalTarget("bam/{0}.rmdup.bam".format(self.sample))
 
     def run(self):
-        suffix = "paired" if self.paired else "single"
-
-        # perform the SAM -> BAM conversion and sorting
-        bam = run_cmd([SAMTOOLS,
-                       "sort",                     # sort the reads
-                       "-l", DEFAULT_COMPRESSION,  # level of compression
-                       "-@", MAX_CPU_CORES,        # number of cores
-                       "-O", "bam",                # output a BAM file
-                       "sam/{0}.{1}.sam".format(self.sample, suffix)],
-                      returnout=True)
 
-        # save the BAM file
-        with self.output().open('w') as fout:
-            fout.write(bam)
+        with self.output().temporary_path() as bam_path:
+            # stream the merged BAM straight into markdup, so the merged file never touches the disk
+            run_pipe([[SAMTOOLS,
+                       "merge",                                 # merge the sorted reads
+                       "-c",                                    # combine the @RG headers
+                       "-u",                                    # uncompressed BAM, as we only read it once
+                       "-@", MAX_CPU_CORES,                     # number of cores
+                       "-",                                     # write the BAM to stdout
+                       "bam/{0}.paired.bam".format(self.sample),
+                       "bam/{0}.single.bam".format(self.sample)],
+
+                      # single pass over the sorted BAM, using the mate tags added by fixmate during the alignment
+                      [SAMTOOLS,
+                       "markdup",
+                       "-r",                                    # remove the duplicates
+                       "-@", MAX_CPU_CORES,                     # number of cores
+                       "-O", "bam,level={0}".format(DEFAULT_COMPRESSION),
+                       "-",                                     # read the BAM from stdin
+                       bam_path]])
 
 
-class SamtoolsMergeBam(luigi.Task):
+class SamtoolsIndexBam(luigi.Task):
     """
-    Merge the two SAM files from the paired and unpaired reads.
+    Create an index for the BAM file, for fast random access
     """
     sample = luigi.Parameter()
     genome = luigi.Parameter()
 
-    def requires(self):
-        # we require both the paired an unpaired BAM files
-        return [SamtoolsSortBam(self.sample, self.genome, True),
-                SamtoolsSortBam(self.sample, self.genome, False)]
-
     def output(self):
-        return luigi.LocalTarget("bam/{0}.bam".format(self.sample))
+        return luigi.LocalTarget("bam/{0}.rmdup.bam.bai".format(self.sample))
+
+    def requires(self):
+        return SamtoolsMarkDuplicates(self.sample, self.genome)
 
     def run(self):
-        # perform the SAM -> BAM conversion and sorting
-        run_cmd([SAMTOOLS,
-                 "merge",                                   # sort the reads
-                 "-c",                                      # combine the @RG headers
-                 "-@", MAX_CPU_CORES,                       # number of cores
-                 "bam/{0}.bam".format(self.sample),         # output file
-                 "bam/{0}.paired.bam".format(self.sample),
-                 "bam/{0}.single.bam".format(self.sample)],
-                returnout=True)
+
+        with self.output().temporary_path() as bai_path:
+            run_cmd([SAMTOOLS,
+                     "index",
+                     "-b",                                      # create a BAI index
+                     "bam/{0}.rmdup.bam".format(self.sample),   # file to index
+                     bai_path])
 
 
-class PicardMarkDuplicates(luigi.Task):
+class SplitIntervals(luigi.Task):
     """
-    Remove PCR duplicates, so we don't overestimate coverage
+    Split the targets list into contiguous chunks, so variant calling can be scattered across several workers
     """
-    sample = luigi.Parameter()
-    genome = luigi.Parameter()
-
-    def requires(self):
-        return SamtoolsMergeBam(self.sample, self.genome)
+    n_chunks = luigi.IntParameter()
 
     def output(self):
-        return luigi.LocalTarget("bam/{0}.rmdup.bam".format(self.sample))
+        # n.b. the number of chunks is part of the path, so chunks from a run with a different number are never reused
+        return [luigi.LocalTarget("intervals/{0}/{1}.list".format(self.n_chunks, i)) for i in range(self.n_chunks)]
 
     def run(self):
 
-        run_cmd(["java", "-jar", PICARD,
-                 "MarkDuplicates",
-                 "INPUT=bam/{0}.bam".format(self.sample),
-                 "OUTPUT=bam/{0}.rmdup.bam".format(self.sample),
-                 "METRICS_FILE=bam/{0}.rmdup.txt".format(self.sample),
-                 "REMOVE_DUPLICATES=true",
-                 "QUIET=true"])
+        with open(TARGETS_LIST, 'r') as fin:
+            intervals = [line for line in fin if line.strip()]
 
+        # keep the chunks contiguous, so they can be gathered back together in order
+        size = -(-len(intervals) // self.n_chunks)
 
-class SamtoolsIndexBam(luigi.Task):
+        for i, target in enumerate(self.output()):
+            with target.open('w') as fout:
+                fout.writelines(intervals[i * size:(i + 1) * size])
+
+
+class GatkHaplotypeCallerChunk(luigi.Task):
     """
-    Create an index for the BAM file, for fast random access
+    Convert one chunk of the BAM file into a gVCF
     """
     sample = luigi.Parameter()
     genome = luigi.Parameter()
-
-    def output(self):
-        return luigi.LocalTarget("bam/{0}.rmdup.bam.bai".format(self.sample))
+    n_chunks = luigi.IntParameter()
+    chunk = luigi.IntParameter()
 
     def requires(self):
-        return PicardMarkDuplicates(self.sample, self.genome)
+        # reference must be indexed properly
+        yield PicardCreateSequenceDictionary(self.genome)
+        yield SamtoolsFaidx(self.genome)
+
+        # bam file must also be indexed
+        yield SamtoolsIndexBam(self.sample, self.genome)
+
+        # and the targets list must be split
+        yield SplitIntervals(self.n_chunks)
+
+    def output(self):
+        return luigi.LocalTarget("vcf/{0}.{1}.{2}.g.vcf".format(self.sample, self.n_chunks, self.chunk))
 
     def run(self):
 
-        run_cmd([SAMTOOLS,
-                 "index",
-                 "-b",                                      # create a BAI index
-                 "bam/{0}.rmdup.bam".format(self.sample)])  # file to index
+        with temporary_vcf_path(self.output().path) as vcf_path:
+            run_cmd(["java", "-Xmx8G", "-jar", GATK,
+                     "-T", "HaplotypeCaller",                   # use the HaplotypeCaller to call variants
+                     "-R", "fasta/{0}.fa".format(self.genome),  # the indexed reference genome
+                     "--genotyping_mode", "DISCOVERY",          # variant discovery
+                     "--emitRefConfidence", "GVCF",             # reference model with condensed non-variant blocks
+                     "--output_mode", "EMIT_ALL_SITES",         # produces calls at any callable site
+                     "-L", "intervals/{0}/{1}.list".format(self.n_chunks, self.chunk),  # limit to this chunk
+                     "-I", "bam/{0}.rmdup.bam".format(self.sample),
+                     "-o", vcf_path])
 
 
 class GatkHaplotypeCaller(luigi.Task):
     """
-    Convert the BAM file into a gVCF
+    Gather the chunks of the gVCF back into a single file
     """
     sample = luigi.Parameter()
     genome = luigi.Parameter()
 
     def requires(self):
-        # reference must be indexed properly
-        yield PicardCreateSequenceDictionary(self.genome)
-        yield SamtoolsFaidx(self.genome)
-
-        # bam file must also be indexed
-        yield SamtoolsIndexBam(self.sample, self.genome)
+        # scatter the variant calling across all the chunks
+        for chunk in range(INTERVAL_CHUNKS):
+            yield GatkHaplotypeCallerChunk(self.sample, self.genome, INTERVAL_CHUNKS, chunk)
 
     def output(self):
         return luigi.LocalTarget("vcf/{0}.g.vcf".format(self.sample))
 
     def run(self):
 
-        run_cmd(["java", "-Xmx8G", "-jar", GATK,
-                 "-T", "HaplotypeCaller",                   # use the HaplotypeCaller to call variants
-                 "-R", "fasta/{0}.fa".format(self.genome),  # the indexed reference genome
-                 "--genotyping_mode", "DISCOVERY",          # variant discovery
-                 "--emitRefConfidence", "GVCF",             # reference model emitted with condensed non-variant blocks
-                 "--output_mode", "EMIT_ALL_SITES",         # produces calls at any callable site
-                 "-L", TARGETS_LIST,                        # limit to the list of regions defined in the targets file
-                 "-I", "bam/{0}.rmdup.bam".format(self.sample),
-                 "-o", "vcf/{0}.g.vcf".format(self.sample)])
+        # make a list of input files, in the same order as the targets list
+        vcf_files = [arg for target in self.input() for arg in ("-V", target.path)]
+
+        # write to a temporary file, so a failed run never leaves a truncated gVCF behind
+        with temporary_vcf_path(self.output().path) as vcf_path:
+            run_cmd(["java", "-cp", GATK, "org.broadinstitute.gatk.tools.CatVariants",
+                     "-R", "fasta/{0}.fa".format(self.genome),  # the indexed reference genome
+                     "-assumeSorted",                           # the chunks are already in order, so just concatenate
+                     "-out", vcf_path]
+                    + vcf_files)
 
 
 class GatkGenotypeGVCFs(luigi.Task):
@@ -308,18 +341,20 @@ class GatkGenotypeGVCFs(luigi.Task):
         # get the min quality threshold for emitting variants
         min_emit_qual = MIN_GENOTYPE_QUAL if self.population != 'OUT' else 1
 
-        # make a list of input files
-        vcf_files = sum([["-V", "vcf/{0}.g.vcf".format(sample)] for sample in self.samples], [])
+        # the list of input files
+        gvcf_files = [arg for sample in self.samples for arg in ("-V", "vcf/{0}.g.vcf".format(sample))]
 
-        run_cmd(["java", "-Xmx8G", "-jar", GATK,
-                 "-T", "GenotypeGVCFs",                     # use GenotypeGVCFs to jointly call variants
-                 "--num_threads", MAX_CPU_CORES,            # number of data threads to allocate to this analysis
-                 "--includeNonVariantSites",                # include sites found to be non-variant after genotyping
-                 "-stand_call_conf", MIN_GENOTYPE_QUAL,     # mark all sites with a phred score below this as LowQual
-                 "-stand_emit_conf", min_emit_qual,         # emit all sites with a phred score above this
-                 "-R", "fasta/{0}.fa".format(self.genome),  # the indexed reference genome
-                 "-o", "vcf/{0}.vcf".format(self.population)]
-                + vcf_files)
+        # write to a temporary file, so a failed run never leaves a truncated VCF behind
+        with temporary_vcf_path(self.output().path) as vcf_path:
+            run_cmd(["java", "-Xmx8G", "-jar", GATK,
+                     "-T", "GenotypeGVCFs",                     # use GenotypeGVCFs to jointly call variants
+                     "--num_threads", MAX_CPU_CORES,            # number of data threads to allocate to this analysis
+                     "--includeNonVariantSites",                # include sites found to be non-variant after genotyping
+                     "-stand_call_conf", MIN_GENOTYPE_QUAL,     # mark sites with a phred score below this as LowQual
+                     "-stand_emit_conf", min_emit_qual,         # emit all sites with a phred score above this
+                     "-R", "fasta/{0}.fa".format(self.genome),  # the indexed reference genome
+                     "-o", vcf_path]
+                    + gvcf_files)
 
 
 class GatkSelectVariants(luigi.Task):
@@ -339,20 +374,19 @@ class GatkSelectVariants(luigi.Task):
 
     def run(self):
 
-        run_cmd(["java", "-Xmx2g", "-jar", GATK,
-                 "-T", "SelectVariants",
-                 "-R", "fasta/{0}.fa".format(self.genome),
-                 "-V", "vcf/{0}.vcf".format(self.population),
-                 "-o", "vcf/{0}.variant.vcf".format(self.population),
-                 "--selectTypeToInclude", "SNP",
-                 "--restrictAllelesTo", "BIALLELIC"])
-
-        # because SelectVariants doesn't handle having "*" in the ALT column we need to grep all those sites out
-        vcf = run_cmd(["grep -Pv '\t\*\t' vcf/" + str(self.population) + ".variant.vcf"], shell=True, returnout=True)
+        # write to a temporary file, so a failed run never leaves a truncated (or unfiltered) VCF behind
+        with temporary_vcf_path(self.output().path) as vcf_path:
+            run_cmd(["java", "-Xmx2g", "-jar", GATK,
+                     "-T", "SelectVariants",
+                     "-R", "fasta/{0}.fa".format(self.genome),
+                     "-V", "vcf/{0}.vcf".format(self.population),
+                     "-o", vcf_path,
+                     "--selectTypeToInclude", "SNP",
+                     "--restrictAllelesTo", "BIALLELIC"])
 
-        # overwrite the vcf with the filtered data
-        with self.output().open('w') as fout:
-            fout.write(vcf)
+            # because SelectVariants doesn't handle having "*" in the ALT column we need to grep all those sites out,
+            # and overwrite the vcf with the filtered data
+            run_cmd_to_file(["grep -Pv '\t\*\t' " + vcf_path], vcf_path, shell=True)
 
 
 class PlinkMakeBed(luigi.Task):
@@ -382,12 +416,9 @@ class PlinkMakeBed(luigi.Task):
                  "--vcf", "vcf/{0}.variant.vcf".format(self.population),
                  "--out", "ped/{0}".format(self.population)])
 
-        # use awk to add variant IDs, so we can identify polyallelic sites during merge
-        data = run_cmd(["awk '$2=$1\"-\"$4' ped/" + str(self.population) + ".map"], returnout=True, shell=True)
-
-        # replace the old map file
-        with open("ped/{0}.map".format(self.population), 'w') as fout:
-            fout.write(data)
+        # use awk to add variant IDs, so we can identify polyallelic sites during merge, and replace the old map file
+        run_cmd_to_file(["awk '$2=$1\"-\"$4' ped/" + str(self.population) + ".map"],
+                        "ped/{0}.map".format(self.population), shell=True)
 
         # convert PED to BED
         run_cmd(["plink",
@@ -532,23 +563,23 @@ class AdmixtureK(luigi.Task):
 
     def run(self):
 
+        # resolve the log file before we change directory
+        log = os.path.abspath(self.output()[2].path)
+
         # admixture only outputs to the current directory
         os.chdir('./admix')
 
-        log = run_cmd(["admixture",
-                       "-j{}".format(MAX_CPU_CORES),                # use multi-threading
-                       "--cv=10",                                   # include cross-validation standard errors
-                       "../bed/{0}.pruned.bed".format(self.group),  # using this input file
-                       self.k],                                     # for K ancestral populations
-                      returnout=True, pwd='../')
+        # save the log file
+        run_cmd_to_file(["admixture",
+                         "-j{}".format(MAX_CPU_CORES),                # use multi-threading
+                         "--cv=10",                                   # include cross-validation standard errors
+                         "../bed/{0}.pruned.bed".format(self.group),  # using this input file
+                         self.k],                                     # for K ancestral populations
+                        log, pwd='../')
 
         # restore previous working directory
         os.chdir('..')
 
-        # save the log file
-        with self.output()[2].open('w') as fout:
-            fout.write(log)
-
 
 class AdmixturePlotK(luigi.Task):
     """
@@ -676,17 +707,13 @@ class sNMF_K(luigi.Task):
 
     def run(self):
 
-        # run sNMF on the geno file, and compute the cross-entropy criterion
-        log = run_cmd(["sNMF",
-                       "-p", MAX_CPU_CORES,
-                       "-x", "snmf/{0}.pruned.geno".format(self.group),
-                       "-K", self.k,
-                       "-c"],
-                      returnout=True)
-
-        # save the log file
-        with self.output()[2].open('w') as fout:
-            fout.write(log)
+        # run sNMF on the geno file, and compute the cross-entropy criterion, saving the log file
+        run_cmd_to_file(["sNMF",
+                         "-p", MAX_CPU_CORES,
+                         "-x", "snmf/{0}.pruned.geno".format(self.group),
+                         "-K", self.k,
+                         "-c"],
+                        self.output()[2].path)
 
 
 class sNMF_PlotK(luigi.Task):
@@ -819,13 +846,10 @@ class FlashPCAPlot(luigi.Task):
 
     def run(self):
 
-        # use awk to add population and sample names, needed for the plot
-        data = run_cmd(["awk '{print $1\"\t\"$2}' bed/" + str(self.group) + ".fam | "
-                        "paste - flashpca/pcs_" + str(self.group) + ".txt"], returnout=True, shell=True)
-
-        # save the labeled file
-        with open("flashpca/pca_{0}.data".format(self.group), 'w') as fout:
-            fout.write(data)
+        # use awk to add population and sample names, needed for the plot, and save the labeled file
+        run_cmd_to_file(["awk '{print $1\"\t\"$2}' bed/" + str(self.group) + ".fam | "
+                         "paste - flashpca/pcs_" + str(self.group) + ".txt"],
+                        "flashpca/pca_{0}.data".format(self.group), shell=True)
 
         # plot the first 6 components
         for pcs1, pcs2 in [(1, 2), (3, 4), (5, 6)]:
@@ -916,4 +940,7 @@ class CustomGenomePipeline(luigi.WrapperTask):
 
 
 if __name__ == '__main__':
+    # run independent samples in parallel, rather than one at a time
+    default_workers(CONCURRENT_WORKERS)
+
     luigi.run()
@@ -1,48 +1,65 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import luigi, subprocess, datetime, hashlib, os, logging, random
-from collections import defaultdict
+import luigi, subprocess, datetime, hashlib, os, logging, random, signal, tempfile, fcntl
+import numpy
+from array import array
+from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
+from distutils.spawn import find_executable
 
 # import all the constants
 from pipeline_consts import *
 
-def run_cmd(cmd, returnout=True, shell=False, pwd='./'):
+# fcntl command for resizing a pipe buffer (from linux/fcntl.h, as python doesn't define it)
+F_SETPIPE_SZ = 1031
+
+logger = logging.getLogger(__name__)
+
+# the short read aligner to use for this run (chosen the first time it's needed, see select_aligner)
+_aligner = []
+
+def run_cmd(cmd, returnout=True, shell=False, pwd='./', outfile=None):
     """
     Executes the given command in a system subprocess
 
     :param cmd: The system command to run (list|string)
     :param shell: Use the native shell
+    :param outfile: Stream stdout directly into this file, instead of returning it
     :return: The stdout stream
     """
     # subprocess only accepts strings
     cmd = [str(args) for args in cmd]
 
-    # TODO remove when done testing
-    print cmd
+    # log the command
+    log_cmd(cmd, " ".join(cmd), pwd)
 
-    # has the command so we can match the logs together
-    m = hashlib.md5()
-    m.update(str(cmd))
+    # let the kernel write the output straight into the file, rather than buffering it all in memory
+    fout = open(outfile, 'wb') if outfile else None
 
-    # log the command
-    with open(pwd + 'log/luigi.cmd.log', 'a+') as fout:
-        fout.write("{time} {hash}# {actn}\n".format(time=str(datetime.datetime.now()),
-                                                    hash=m.hexdigest(),
-                                                    actn=" ".join(cmd)))
+    # spool stderr to disk, so a chatty command doesn't fill up our memory
+    err = tempfile.TemporaryFile()
 
     # run the command
     proc = subprocess.Popen(cmd,
                             shell=shell,
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
+                            stdout=fout or subprocess.PIPE,
+                            stderr=err)
+
+    # fetch the output
+    (stdout, _) = proc.communicate()
+
+    if fout:
+        fout.close()
 
-    # fetch the output and error
-    (stdout, stderr) = proc.communicate()
+    logger.debug("cmd=%r rc=%d", cmd, proc.returncode)
 
     # bail if something went wrong
     if proc.returncode:
-        raise Exception(stderr)
+        err.seek(0)
+        raise Exception(err.read())
+
+    err.close()
 
     if returnout:
         return stdout
@@ -52,72 +69,365 @@ def run_cmd(cmd, returnout=True, shell=False, pwd='./'):
         pass
 
 
-def unzip_file(gzip):
+def run_cmd_to_file(cmd, outfile, shell=False, pwd='./'):
+    """
+    Executes the given command in a system subprocess, streaming stdout into a file which is only moved into place
+    if the command succeeds
+
+    :param cmd: The system command to run (list|string)
+    :param outfile: The path of the output file
+    :param shell: Use the native shell
+    """
+    # n.b. we can't use luigi's temporary_path() because some commands overwrite existing files (e.g. their input)
+    tmp_path = outfile + '.tmp'
+
+    try:
+        run_cmd(cmd, shell=shell, pwd=pwd, outfile=tmp_path)
+    except Exception:
+        # don't leave partial output lying around
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    # atomically replace the output file
+    os.rename(tmp_path, outfile)
+
+
+@contextmanager
+def temporary_vcf_path(path):
+    """
+    Context manager for writing a VCF to a temporary file, which is only moved into place (along with its index) if
+    the block succeeds
+
+    n.b. we can't use luigi's temporary_path() because GATK chooses the output format from the file extension
+
+    :param path: The path of the output VCF
+    :return: The temporary path to write to
+    """
+    tmp_path = os.path.join(os.path.dirname(path), 'tmp.' + os.path.basename(path))
+
+    try:
+        yield tmp_path
+    except Exception:
+        # don't leave partial output lying around
+        for tmp in [tmp_path, tmp_path + '.idx']:
+            if os.path.isfile(tmp):
+                os.remove(tmp)
+        raise
+
+    # move the index first, so the VCF is never in place without it
+    if os.path.isfile(tmp_path + '.idx'):
+        os.rename(tmp_path + '.idx', path + '.idx')
+
+    os.rename(tmp_path, path)
+
+
+def run_pipe(cmds, outfile=None, pwd='./'):
+    """
+    Executes the given commands as a pipeline of system subprocesses, streaming the stdout of each command into the
+    stdin of the next, so that intermediate data never has to be buffered in Python or written to disk
+
+    :param cmds: The list of system commands to chain together (list of lists)
+    :param outfile: Stream the stdout of the last command directly into this file
+    :return: The stdout stream of the last command
+    """
+    # subprocess only accepts strings
+    cmds = [[str(args) for args in cmd] for cmd in cmds]
+
+    # log the whole pipeline as a single command
+    log_cmd(cmds, " | ".join(" ".join(cmd) for cmd in cmds), pwd)
+
+    procs = []
+    errs = []
+
+    # the last command either writes to the output file or back to us
+    fout = open(outfile, 'wb') if outfile else None
+
+    try:
+        for i, cmd in enumerate(cmds):
+            # spool stderr to disk, because a chatty command (e.g. bwa) would otherwise block once the pipe buffer is
+            # full
+            err = tempfile.TemporaryFile()
+
+            # chain the stdout of the previous command into this one
+            proc = subprocess.Popen(cmd,
+                                    stdin=procs[-1].stdout if procs else None,
+                                    stdout=fout if fout and i == len(cmds) - 1 else subprocess.PIPE,
+                                    stderr=err)
+
+            if proc.stdout:
+                # enlarge the pipe buffer, so the commands aren't constantly blocking on 64 KiB writes
+                set_pipe_size(proc.stdout, IO_BUFFER_SIZE)
+
+            if procs:
+                # close our copy of the pipe, so the previous command gets a SIGPIPE if this one dies
+                procs[-1].stdout.close()
+
+            procs.append(proc)
+            errs.append(err)
+    except Exception:
+        # don't leave the commands we've already started running with nobody reading their output
+        for proc in procs:
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+
+        if fout:
+            fout.close()
+        raise
+
+    # fetch the output of the last command, then wait for the rest of the pipeline to finish
+    stdout = procs[-1].communicate()[0]
+
+    for proc in procs[:-1]:
+        proc.wait()
+
+    if fout:
+        fout.close()
+
+    # bail if something went wrong (ignoring commands that were only killed because a later one died)
+    failed = [err for proc, err in zip(procs, errs) if proc.returncode and proc.returncode != -signal.SIGPIPE] \
+             or [err for proc, err in zip(procs, errs) if proc.returncode]
+
+    if failed:
+        failed[0].seek(0)
+        raise Exception(failed[0].read())
+
+    return stdout
+
+
+def set_pipe_size(pipe, size):
+    """
+    Resize the kernel buffer of a pipe (Linux only, and capped by /proc/sys/fs/pipe-max-size)
+
+    :param pipe: The pipe file object
+    :param size: The requested buffer size in bytes
+    """
+    try:
+        fcntl.fcntl(pipe.fileno(), F_SETPIPE_SZ, size)
+    except IOError:
+        # not supported, or larger than the system maximum, so just leave the default buffer
+        pass
+
+
+def log_cmd(cmd, actn, pwd='./'):
     """
-    Unzip a gzipped file, using multi-threading when available
+    Appends the given command to the command log
 
-    :param gzip: The path to the gzip file
-    :return: The uncompressed data stream
+    :param cmd: The system command being run
+    :param actn: The human readable version of the command
     """
+    # hash the command so we can match the logs together
+    m = hashlib.md5()
+    m.update(str(cmd))
+
+    with open(pwd + 'log/luigi.cmd.log', 'a+') as fout:
+        fout.write("{time} {hash}# {actn}\n".format(time=str(datetime.datetime.now()),
+                                                    hash=m.hexdigest(),
+                                                    actn=actn))
+
+
+def default_workers(workers):
+    """
+    Set the default number of luigi workers, unless it has been set in luigi.cfg (n.b. --workers on the command line
+    will still take precedence)
+
+    :param workers: The number of workers
+    """
+    config = luigi.configuration.get_config()
+
+    if not config.has_section('core'):
+        config.add_section('core')
+
+    if not config.has_option('core', 'workers'):
+        config.set('core', 'workers', str(workers))
+
+
+def select_aligner():
+    """
+    Choose the fastest short read aligner which is installed and supported by this CPU (the BWA_BIN environment
+    variable can be used to choose one explicitly)
+
+    :return: The aligner settings, from ALIGNERS
+    """
+    # only probe the system once per run
+    if not _aligner:
+        _aligner.append(probe_aligner())
+
+    return _aligner[0]
+
+
+def probe_aligner():
+    """
+    Find the fastest supported aligner (see select_aligner)
+
+    :return: The aligner settings, from ALIGNERS
+    """
+    if os.environ.get('BWA_BIN'):
+        for aligner in ALIGNERS:
+            if aligner['bin'] == os.environ['BWA_BIN']:
+                return aligner
+
+        raise Exception("BWA_BIN must be one of: {}".format(", ".join(aligner['bin'] for aligner in ALIGNERS)))
+
     try:
-        # use unpigz for multithreaded unzipping (if installed)
-        return run_cmd(["unpigz",
-                        "-c",                 # output to stdout
-                        "-p", MAX_CPU_CORES,  # use the maximum cores
-                        gzip])                # gzip file
+        with open('/proc/cpuinfo') as fin:
+            cpu_flags = set(flag for line in fin if line.startswith('flags') for flag in line.split(':')[1].split())
+    except IOError:
+        cpu_flags = set()
 
-    except OSError as e:
-        # if it's not installed
-        if e.errno == os.errno.ENOENT:
+    for aligner in ALIGNERS:
+        if find_executable(aligner['bin']) and (not aligner['cpu_flag'] or aligner['cpu_flag'] in cpu_flags):
+            return aligner
 
-            # use single-threaded gunzip
-            return run_cmd(["gunzip",
-                            "-c",             # output to stdout
-                            gzip])            # gzip file
-        else:
-            # escalate the exception
-            raise e
+    # fall back to plain bwa, even if we can't find it
+    return ALIGNERS[-1]
 
 
-def curl_download(url, filename):
+def unzip_cmd():
     """
-    Downloads a remote url to a local file path using cURL
+    Get the command for decompressing a gzip stream, using multi-threading when available
+
+    :return: The system command, which reads from stdin and writes to stdout
     """
+    # use unpigz for multithreaded unzipping (if installed)
+    if find_executable("unpigz"):
+        return ["unpigz",
+                "-c",                 # output to stdout
+                "-p", MAX_CPU_CORES]  # use the maximum cores
 
-    # download the file
-    run_cmd(["curl",
-             "-s",                  # download silently
-             "--output", filename,  # output path
-             url])                  # from this url
+    # otherwise, use single-threaded gunzip
+    return ["gunzip",
+            "-c"]                     # output to stdout
 
 
-def random_params(lower_bound, upper_bound, fixed_params):
+def random_params(lower_bound, upper_bound, fixed_params, size=None):
     """
     Randomly generate starting params, within the bounding ranges, with fixed params
+
+    :param size: The number of sets of params to generate (if None, then return a single set)
     """
 
-    # make random params
-    random_params = [random.uniform(lower_bound[i], upper_bound[i])
-                     for i in range(0, len(upper_bound))]
+    # make random params (all in one call to the RNG)
+    random_params = numpy.random.uniform(lower_bound, upper_bound, size=(size or 1, len(upper_bound)))
 
     # enforce any fixed params
     if fixed_params:
-        for i in range(0, len(fixed_params)):
-            if fixed_params[i] is not None:
-                random_params[i] = fixed_params[i]
+        fixed = [i for i in range(0, len(fixed_params)) if fixed_params[i] is not None]
+        random_params[:, fixed] = [fixed_params[i] for i in fixed]
 
-    return random_params
+    return random_params[0].tolist() if size is None else random_params.tolist()
 
-def extract_variant_sites(population, samples, variants):
+
+def memoize_model(func_ex, maxsize=DADI_CACHE_SIZE, sig_figs=DADI_CACHE_SIG_FIGS):
+    """
+    Wrap a dadi model function with a least-recently-used cache, so that params which the optimiser revisits (e.g. when
+    restarting from the best fit so far) don't need another PDE solve
+
+    :param func_ex: The (extrapolating) model function, called as func_ex(params, ns, pts)
+    :param maxsize: The maximum number of model spectra to keep
+    :param sig_figs: Params are rounded to this many significant figures, so that near-identical params share a
+                     result
+    :return: The memoized model function
+    """
+    cache = OrderedDict()
+
+    def cached_func_ex(params, ns, pts):
+        key = (tuple(float('%.*g' % (sig_figs, x)) for x in params), tuple(ns), tuple(pts))
+
+        try:
+            # move the hit to the end of the queue
+            model = cache.pop(key)
+        except KeyError:
+            model = func_ex(params, ns, pts)
+
+            # evict the least recently used model
+            if len(cache) >= maxsize:
+                cache.popitem(last=False)
+
+        cache[key] = model
+
+        return model
+
+    return cached_func_ex
+
+
+def memoize(func):
+    """
+    Decorator to cache the results of a function, keyed on its (hashable) arguments, for the life of the process
+
+    :param func: The function to memoize
+    :return: The memoized function
+    """
+    cache = dict()
+
+    def memoized_func(*args):
+        if args not in cache:
+            cache[args] = func(*args)
+        return cache[args]
+
+    return memoized_func
+
+@contextmanager
+def log_to_file(path, level=logging.DEBUG):
+    """
+    Send all the log messages to the given file for the duration of the block
+
+    n.b. logging.basicConfig only works once per process, so later tasks in the same worker would log to the wrong file
+
+    :param path: The log file
+    :param level: The minimum level to log
+    """
+    root = logging.getLogger()
+    handler = logging.FileHandler(path)
+    old_level = root.level
+
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    try:
+        yield
+    finally:
+        root.removeHandler(handler)
+        root.setLevel(old_level)
+        handler.close()
+
+
+def extract_variant_sites(population, samples):
+    """
+    Extract the allele counts for all the usable sites in the VCF file of the given population
+
+    :param population: The population name
+    :param samples: List of the samples in the population
+    :return: Tuple of arrays (chroms, sites, refs, alts, counts), where chroms are the chromosome names indexed by
+             their id, and the rest have one row per site, keyed by chrom_id << 32 | pos, with counts of the number of
+             ref and alt alleles (n.b. alt is the same as ref for invariant sites)
+    """
 
     # is this the outgroup population (because we don't quality filter the outgroup)
     is_outgroup = (population == 'OUT')
 
+    # the minimum joint depth, so that the average depth is at least MIN_COVERAGE_DEPTH (without dividing every site)
+    min_joint_depth = MIN_COVERAGE_DEPTH * len(samples)
+
     # keep track of indels so we can filter SNPs within ±10 bases
     indels = []
 
-    # parse the population VCF file
-    with open('./vcf/' + population + '.vcf', 'r') as infile:
+    # count the rejected sites, and only log each one when debugging (as formatting millions of messages is slow)
+    rejected = defaultdict(int)
+    debug = logger.isEnabledFor(logging.DEBUG)
+
+    # store the sites as columns of plain values, as a dictionary per site takes far too much memory
+    sites, refs, alts = array('l'), bytearray(), bytearray()
+
+    # number the chromosomes as we find them, so each site can be keyed by a single integer
+    chrom_ids = dict()
+
+    # the allele counts can't exceed twice the number of samples, so use the smallest unsigned type that fits
+    counts = array('B' if 2 * len(samples) <= 0xFF else 'H')
+
+    # parse the population VCF file (with a large read buffer, as we stream through the whole file)
+    with open('./vcf/' + population + '.vcf', 'r', IO_BUFFER_SIZE) as infile:
 
         # get the first line
         header = infile.readline()
@@ -129,127 +439,179 @@ def extract_variant_sites(population, samples, variants):
         # get the column headers
         columns = header.split()
 
-        for line in infile:
+        # make sure all the samples are in the VCF before we start parsing it
+        missing = [sample for sample in samples if sample not in columns[GENOTYPE:]]
 
-            # convert string to list
-            locus = line.split()
+        if missing:
+            raise Exception("{}: samples missing from the VCF: {}".format(population, ", ".join(missing)))
 
-            # index by chromosome and position
-            site = (locus[CHROM], int(locus[POS]))
+        # find the sample columns once, rather than searching the header for every sample at every site (n.b. these
+        # are offsets into the genotype columns)
+        sample_cols = [columns.index(sample) - GENOTYPE for sample in samples]
 
-            # skip low quality sites
-            if 'LowQual' in locus[FILTER] and not is_outgroup:
-                logging.debug('{}\t{}\tLowQual\t{}'.format(population, site, locus[QUAL]))
-                continue
+        # the FORMAT string rarely changes between sites, so only find the genotype field when it does
+        last_format, GT = None, None
 
-            # extract the locus info
-            info = dict(item.split("=") for item in locus[INFO].split(";"))
+        for line in infile:
 
-            # get the joint depth (handle sites with no coverage)
-            joint_depth = int(info['DP']) if 'DP' in info else 0
+            # convert string to list, but leave the genotype columns as one string until the site passes the filters
+            locus = line.split('\t', GENOTYPE)
 
-            # skip low coverage sites (average depth must be > MIN_COVERAGE_DEPTH)
-            if joint_depth/len(samples) < MIN_COVERAGE_DEPTH and not is_outgroup:
-                logging.debug('{}\t{}\tLowDepth\t{}/{}'.format(population, site, joint_depth, len(samples)))
-                continue
+            # we don't quality filter the outgroup, so don't even look at its quality and depth
+            if not is_outgroup:
+
+                # skip low quality sites
+                if 'LowQual' in locus[FILTER]:
+                    rejected['LowQual'] += 1
+                    if debug:
+                        logger.debug('%s\t%s:%s\tLowQual\t%s', population, locus[CHROM], locus[POS], locus[QUAL])
+                    continue
+
+                # get the joint depth, without splitting up the whole locus info (handle sites with no coverage)
+                depth = (';' + locus[INFO]).partition(';DP=')[2].partition(';')[0]
+                joint_depth = int(depth) if depth else 0
+
+                # skip low coverage sites (average depth must be > MIN_COVERAGE_DEPTH)
+                if joint_depth < min_joint_depth:
+                    rejected['LowDepth'] += 1
+                    if debug:
+                        logger.debug('%s\t%s:%s\tLowDepth\t%s/%s', population, locus[CHROM], locus[POS],
+                                     joint_depth, len(samples))
+                    continue
 
             # get the reference allele
             ref = locus[REF]
 
             # get the alternative allele(s)
-            alt_list = locus[ALT].split(',')
+            alt = locus[ALT]
 
-            # deal with the stupid <NON_REF> notation used by GATK... grrr...
-            if '<NON_REF>' in alt_list:
-                alt_list.remove('<NON_REF>')
+            # most sites only have one alt allele, so only split the list when there is one
+            if ',' in alt:
+                # deal with the stupid <NON_REF> notation used by GATK... grrr... (and also the "." notation)
+                alt_list = [allele for allele in alt.split(',') if allele not in NO_ALT_ALLELE]
 
-            # also handle the "." notation
-            if '.' in alt_list:
-                alt_list.remove('.')
+                # skip polyallelic sites
+                if len(alt_list) > 1:
+                    rejected['PolyAllelic'] += 1
+                    if debug:
+                        logger.debug('%s\t%s:%s\tPolyAllelic\t%s/%s', population, locus[CHROM], locus[POS], ref,
+                                     alt_list)
+                    continue
 
-            # skip polyallelic sites
-            if len(alt_list) > 1:
-                logging.debug('{}\t{}\tPolyAllelic\t{}/{}'.format(population, site, ref, alt_list))
-                continue
+                # resolve empty list issue
+                alt = ref if not alt_list else alt_list[0]
 
-            # resolve empty list issue
-            alt = ref if not alt_list else alt_list[0]
+            elif alt in NO_ALT_ALLELE:
+                alt = ref
 
             # skip indels
             if len(ref) > 1 or len(alt) > 1:
-                logging.debug('{}\t{}\tInDel\t{}/{}'.format(population, site, ref, alt))
+                rejected['InDel'] += 1
+                if debug:
+                    logger.debug('%s\t%s:%s\tInDel\t%s/%s', population, locus[CHROM], locus[POS], ref, alt)
 
                 # get the size of the indel
                 size = max(len(ref), len(alt))
 
                 # remember where we found the indel and its size
-                indels.append(site + (size,))
+                indels.append((site_key(chrom_ids, locus), size))
                 continue
 
             # skip sites around indels
             if alt == "*":
                 continue
 
-            if site not in variants:
-                # initialise site locus dictionary
-                variants[site] = dict()
+            # get the index of the genotype field (e.g. GT:AD:DP:GQ:PL:SB)
+            if locus[FORMAT] != last_format:
+                last_format = locus[FORMAT]
+                GT = last_format.split(':').index('GT') # Genotype (1/1, 0/0, 0/1)
+
+            # now split the genotype columns
+            genotypes = locus[GENOTYPE].split()
 
-            if 'ref' not in variants[site]:
-                # remember the reference allele
-                variants[site]['ref'] = ref
+            ref_count, alt_count = 0, 0
 
-            for allele in [ref, alt]:
-                # initialise the allele count dictionary
-                if allele not in variants[site]:
-                    variants[site][allele] = defaultdict(int)
+            # count the observed alleles
+            for col in sample_cols:
 
-            # get the indices for the genotype column (e.g. GT:AD:DP:GQ:PL:SB)
-            format = locus[FORMAT].split(':')
+                # get the genotype for the sample (only splitting as far as the genotype field)
+                genotype = genotypes[col].split(':', GT + 1)[GT]
 
-            GT = format.index('GT') # Genotype (1/1, 0/0, 0/1)
+                # look up the number of ref and alt alleles (skipping missing genotypes, e.g. ./.)
+                calls = GENOTYPE_CALLS.get(genotype)
 
-            # populate the variant dictionary
-            for sample in samples:
+                if calls:
+                    ref_count += calls[0]
+                    alt_count += calls[1]
 
-                # get the genotype for the sample
-                genotype = locus[columns.index(sample)].split(':')
+            # invariant sites only have the one allele
+            if alt == ref:
+                ref_count, alt_count = ref_count + alt_count, 0
 
-                # count the observed alleles
-                if genotype[GT] == '0/0':
-                    # homozygous reference
-                    variants[site][ref][population] += 2
+                # an invariant site without any calls tells us nothing, so don't bother keeping it
+                if not ref_count:
+                    continue
 
-                elif genotype[GT] == '0/1':
-                    # heterozygous
-                    variants[site][ref][population] += 1
-                    variants[site][alt][population] += 1
+            sites.append(site_key(chrom_ids, locus))
+            refs += ref
+            alts += alt
+            counts.extend((ref_count, alt_count))
 
-                elif genotype[GT] == '1/1':
-                    # homozygous alternate
-                    variants[site][alt][population] += 2
+    chroms = numpy.array(sorted(chrom_ids, key=chrom_ids.get), dtype=str)
+    sites = numpy.frombuffer(sites, dtype=numpy.int_)
+    refs = numpy.frombuffer(refs, dtype='S1')
+    alts = numpy.frombuffer(alts, dtype='S1')
+    counts = numpy.frombuffer(counts, dtype=counts.typecode).reshape(-1, 2)
 
     # filter sites within ±10 bases of each indel
-    for indel in indels:
-        chrom, pos, size = indel
+    near = near_indels(sites, indels)
 
-        # filter any site within 10 bases
-        sites = [(chrom, pos + offset) for offset in range(-INDEL_BUFFER, (size + INDEL_BUFFER + 1))]
+    rejected['InDelProximity'] = near.sum()
 
-        for site in sites:
-            # check each allele for the current population
-            for allele in list(variants.get(site, [])):
-                if population in variants[site][allele]:
-                    # remove the current population, but leave the others
-                    del variants[site][allele][population]
-                    # if this was the only population, then remove the allele entirely
-                    if len(variants[site][allele]) == 0:
-                        del variants[site][allele]
-                    logging.debug('{}\t{}\tInDelProximity\t{}'.format(population, site, indel))
+    # log a summary of the rejected sites
+    for reason in sorted(rejected):
+        logger.info('%s\t%s\t%d', population, reason, rejected[reason])
+
+    return chroms, sites[~near], refs[~near], alts[~near], counts[~near]
+
+
+def site_key(chrom_ids, locus):
+    """
+    Key a VCF site by a single integer, packing the chromosome id into the high bits and the position into the low bits
+
+    :param chrom_ids: Dictionary of chromosome ids (new chromosomes are added to it)
+    :param locus: The VCF row
+    """
+    return (chrom_ids.setdefault(locus[CHROM], len(chrom_ids)) << 32) | int(locus[POS])
+
+
+def near_indels(sites, indels):
+    """
+    Find all the sites within INDEL_BUFFER bases of any of the indels
+
+    :param sites: Array of site keys (see site_key)
+    :param indels: List of (site, size) tuples
+    :return: Boolean array, which is True for the sites near an indel
+    """
+    if not indels:
+        return numpy.zeros(len(sites), dtype=bool)
+
+    # get the window around each indel (n.b. the site keys are ordered by chromosome, then position, so a window that
+    # starts before the beginning of a chromosome can't reach any sites on the previous one)
+    starts, ends = numpy.array(sorted((site - INDEL_BUFFER, site + size + INDEL_BUFFER) for site, size in indels)).T
+
+    # the windows can overlap, so track the furthest end of all the windows that start before each one
+    ends = numpy.maximum.accumulate(ends)
+
+    # find the last window to start before each site, and check if any of the windows reach that far
+    idx = numpy.searchsorted(starts, sites, side='right') - 1
+
+    return (idx >= 0) & (ends[numpy.maximum(idx, 0)] >= sites)
 
 
 def find_flanking_bases(variants):
 
-    with open('./vcf/OUT.vcf', 'r') as infile:
+    with open('./vcf/OUT.vcf', 'r', IO_BUFFER_SIZE) as infile:
 
         # skip over the block comments
         while infile.readline().startswith("##"):
@@ -281,111 +643,126 @@ def find_flanking_bases(variants):
                 variants[flank2]['alt_lft'] = alt
 
 
-def generate_frequency_spectrum(populations):
+def generate_frequency_spectrum(populations, fout):
     """
-    Generates the site frequency spectrum for a given set of populations
+    Generates the site frequency spectrum for a given set of populations, and writes it to the given file
 
-    :param populations: Dictionary of populations
+    :param populations: Dictionary of the sites extracted from each population (see extract_variant_sites)
+    :param fout: File handle to write the fsdata to, one site at a time
     :return:
     """
 
-    # create a dictionary of variant sites
-    variants = dict()
+    pop_list = list(populations)
+    pop_list.sort()
+
+    pop_sites = [populations[pop] for pop in pop_list]
+
+    # the chromosome ids are different in each population, so number them all by their sorted names instead (which
+    # means that sorting the site keys will also sort the sites by chromosome name)
+    chroms = numpy.unique(numpy.concatenate([pop[0] for pop in pop_sites]))
+
+    for i, (pop_chroms, sites, refs, alts, counts) in enumerate(pop_sites):
+        chrom_idx = numpy.searchsorted(chroms, pop_chroms)
+        pop_sites[i] = ((chrom_idx[sites >> 32] << 32) | (sites & 0xFFFFFFFF), refs, alts, counts)
+
+    # stack the sites from all the populations into one table, labelled by population
+    sites, refs, alts, counts = [numpy.concatenate(column) for column in zip(*pop_sites)]
+    pop_idx = numpy.repeat(numpy.arange(len(pop_list)), [len(pop[0]) for pop in pop_sites])
+
+    # sort the table by site, so we can group the rows from each population
+    order = numpy.argsort(sites, kind='mergesort')
+    sites, refs, alts, counts, pop_idx = [column[order] for column in (sites, refs, alts, counts, pop_idx)]
 
-    # parse each of the populations and extract the variant sites
-    for pop in populations:
-        extract_variant_sites(pop, populations[pop], variants)
+    # find the first row of each site, and label each row with the index of its site
+    first = numpy.ones(len(order), dtype=bool)
+    first[1:] = sites[1:] != sites[:-1]
+    starts = numpy.flatnonzero(first)
+    site_idx = numpy.cumsum(first) - 1
+    num_sites = len(starts)
 
-    # delete all the sites that don't conform to our requirements
-    for site in list(variants):
+    # find the range of alternative alleles at each site (ignoring the invariant rows, which have no alt allele)
+    invariant = alts == refs
+    alt_min = numpy.minimum.reduceat(numpy.where(invariant, 255, alts.view(numpy.uint8)), starts)
+    alt_max = numpy.maximum.reduceat(numpy.where(invariant, 0, alts.view(numpy.uint8)), starts)
 
-        # remove all pollyallelic sites (3 = 2 x observed alleles + 1 dict key for the ref allele)
-        if len(variants[site]) > 3:
-            del variants[site]
-            continue
+    # sum the allele counts for each population at each site (as an array of sites x populations x [ref, alt])
+    bins = (site_idx * len(pop_list) + pop_idx)[:, numpy.newaxis] * 2 + [0, 1]
+    site_counts = numpy.bincount(bins.ravel(), weights=counts.ravel(), minlength=num_sites * len(pop_list) * 2)
+    site_counts = site_counts.astype(numpy.int_).reshape(num_sites, len(pop_list), 2)
 
-        # find the ancestral allele(s)
-        ancestral = [allele for allele in variants[site] if 'OUT' in variants[site][allele]]
+    # remove all pollyallelic sites
+    viable = (alt_max == 0) | (alt_min == alt_max)
 
-        # skip all het sites in the outgroup and those without coverage
-        if len(ancestral) != 1:
-            del variants[site]
-            continue
+    # the ancestral allele is the one observed in the outgroup
+    out_ref, out_alt = (site_counts[:, pop_list.index('OUT')] > 0).T
 
-        # remember the ancestral allele
-        variants[site]['alt'] = ancestral[0]
+    # skip all het sites in the outgroup and those without coverage
+    viable &= out_ref != out_alt
 
     # record the number of viable sites (we need this for scaling theta in the output from dadi)
-    viable_sites = len(variants)
+    viable_sites = viable.sum()
 
     # now lets drop all the non variant sites
-    for site in list(variants):
-        # (4 = 2 x observed alleles + 2 dict keys for the ref and ancestral alleles)
-        if len(variants[site]) < 4:
-            del variants[site]
+    variable = numpy.flatnonzero(viable & (alt_max > 0))
+
+    site_chroms = chroms[sites[starts[variable]] >> 32].tolist()
+    site_positions = (sites[starts[variable]] & 0xFFFFFFFF).tolist()
+    site_refs = refs[starts[variable]].tolist()
+    site_alts = alt_max[variable].view('S1').tolist()
+    site_ancestral = numpy.where(out_ref[variable], site_refs, site_alts).tolist()
+    site_counts = site_counts[variable]
 
     # now we've whittled down the sites, lets find the flanking bases
+    variants = dict(((chrom, pos), dict()) for chrom, pos in zip(site_chroms, site_positions))
     find_flanking_bases(variants)
 
-    # convert to a list, because dictionaries are not sorted and we need the iteration to be consistent
-    site_list = list(variants)
-    site_list.sort()
-
-    pop_list = list(populations)
-    pop_list.sort()
-
     # remove the pseudo-population OUT
+    out_idx = pop_list.index('OUT')
     pop_list.remove('OUT')
+    site_counts = numpy.delete(site_counts, out_idx, axis=1)
 
     # start composing the output file
-    output = "# Number of viable sites: {}\n".format(viable_sites)
-    output += 'Rabbit\tHare\t'
+    header = ['Rabbit', 'Hare']
 
-    for num in [1,2]:
-        output += 'Allele{}\t'.format(num)
+    for num in [1, 2]:
+        header.append('Allele{}'.format(num))
+        header += pop_list
 
-        for pop in pop_list:
-            output += '{}\t'.format(pop)
+    header += ['Chrom', 'Pos']
 
-    output += 'Chrom\tPos\n'
+    fout.write("# Number of viable sites: {}\n".format(viable_sites))
+    fout.write('\t'.join(header) + '\n')
 
-    for site in site_list:
+    for i, site in enumerate(zip(site_chroms, site_positions)):
 
         # get the chrom and pos
         chrom, pos = site
 
-        # get the ref and alt alleles
-        ref = variants[site].pop('ref')
-        ref_lft = variants[site].pop('ref_lft', '-')
-        ref_rgt = variants[site].pop('ref_rgt', '-')
+        # get the ref and alt alleles, and their flanking bases
+        ref = site_refs[i]
+        ref_lft = variants[site].get('ref_lft', '-')
+        ref_rgt = variants[site].get('ref_rgt', '-')
 
-        alt = variants[site].pop('alt')
-        alt_lft = variants[site].pop('alt_lft', '-')
-        alt_rgt = variants[site].pop('alt_rgt', '-')
+        alt = site_ancestral[i]
+        alt_lft = variants[site].get('alt_lft', '-')
+        alt_rgt = variants[site].get('alt_rgt', '-')
 
         # output the alleles and their flanking bases
-        output += '{}{}{}\t'.format(ref_lft, ref, ref_rgt)
-        output += '{}{}{}\t'.format(alt_lft, alt, alt_rgt)
-
-        # make sure the ref allele is first in the list
-        alleles = list(variants[site])
-        alleles.insert(0, alleles.pop(alleles.index(ref)))
+        line = ['{}{}{}'.format(ref_lft, ref, ref_rgt),
+                '{}{}{}'.format(alt_lft, alt, alt_rgt)]
 
-        # output each of the alleles
-        for allele in alleles:
-            output += '{}\t'.format(allele)
-
-            # output the allele count for each population
-            for pop in pop_list:
-                # note that SNPs cannot be projected up, so SNPs without enough calls in any population will be ignored
-                # https://bitbucket.org/gutenkunstlab/dadi/wiki/DataFormats
-                count = variants[site][allele][pop] if pop in variants[site][allele] else 0
-                output += '{}\t'.format(count)
+        # output each of the alleles, with the ref allele first, and the allele count for each population
+        # n.b. SNPs cannot be projected up, so SNPs without enough calls in any population will be ignored
+        # https://bitbucket.org/gutenkunstlab/dadi/wiki/DataFormats
+        for allele, allele_counts in zip([ref, site_alts[i]], site_counts[i].T.tolist()):
+            line.append(allele)
+            line += [str(count) for count in allele_counts]
 
         # output the chromosome and position of the SNP
-        output += 'chr{}\t{}\n'.format(chrom, pos)
+        line += ['chr{}'.format(chrom), str(pos)]
 
-    return output
+        # write each site as soon as it is composed, rather than holding the whole file in memory
+        fout.write('\t'.join(line) + '\n')
 
 
 class LogBuffer(object):
@@ -398,9 +775,30 @@ class LogBuffer(object):
         self.log.append(data)
 
 
+class MaskedFilter(logging.Filter):
+    """
+    Logging filter which flags when dadi warns that the model is masked, without buffering every log message
+    """
+    masked = False
+
+    # the number of masked warnings, so they can be summarised rather than logged individually
+    count = 0
+
+    def filter(self, record):
+        if "Model is masked" in record.getMessage():
+            self.masked = True
+            self.count += 1
+
+            # demote the warning, as we summarise it ourselves (but it's still there when debugging)
+            record.levelno = logging.DEBUG
+            record.levelname = logging.getLevelName(logging.DEBUG)
+
+        return True
+
+
 class PrioritisedTask(luigi.Task):
     """
-    PrioritisedTask that implements a dynamic priority method
+    PrioritisedTask that implements a dynamic priority method (for a batch of model scenarios)
     """
     @property
     def priority(self):
@@ -414,13 +812,22 @@ class PrioritisedTask(luigi.Task):
             elif self.pop1 == "WLD-IB2":
                 p += 5
 
-        if self.model == "IM":
-            p += 5
+        # the batch is as important as its most important scenario
+        p += max(scenario_priority(s['model'], s['scenario']) for s in self.scenarios)
 
-        if self.scenario == "best-fit":
-            p += 10
+        return p
 
-        if self.n < 20:
-            p += 20
 
-        return p
+def scenario_priority(model, scenario):
+    """
+    The extra priority of a model scenario
+    """
+    p = 0
+
+    if model == "IM":
+        p += 5
+
+    if scenario == "best-fit":
+        p += 10
+
+    return p